@@ -1,51 +1,322 @@
 import os
-import requests
+import threading
 from flask import (
+    Blueprint,
     Flask,
+    current_app,
+    has_app_context,
     url_for,
     render_template,
     redirect,
     request,
     flash,
     json,
-    jsonify
+    jsonify,
+    Markup,
+    Response,
+    stream_with_context
 )
 from flask_pymongo import PyMongo
+from werkzeug.middleware.proxy_fix import ProxyFix
+from jinja2 import FileSystemBytecodeCache
+from assets import (
+    VENDOR,
+    Assets,
+    build_assets,
+    missing_vendor_assets,
+    vendor_assets
+)
+from images import build_images
+from cache import LRUCache, PageCache
+from metrics import RequestMetrics
+from ratelimit import RateLimiter
+from reference import ReferenceData
+from search import SearchIndex
+from pymongo import (
+    ASCENDING,
+    DESCENDING,
+    TEXT,
+    ReplaceOne,
+    UpdateMany,
+    UpdateOne
+)
+from pymongo.errors import (
+    BulkWriteError,
+    ConnectionFailure,
+    DuplicateKeyError,
+    OperationFailure,
+    PyMongoError
+)
+from pymongo.read_preferences import ReadPreference
+from bson import BSON
 from bson.objectid import ObjectId
-from statistics import mean
-from datetime import date
-import array
+import click
+import csv
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from datetime import date, datetime, time, timedelta, timezone
+from time import perf_counter, sleep
 from os import path
 if path.exists("env.py"):
     import env
 
 
-app = Flask(__name__)
+mongo = PyMongo()
+assets = Assets()
+page_cache = PageCache()
+# rendered book cards of the book lists
+fragment_cache = LRUCache()
+request_metrics = RequestMetrics()
+rate_limiter = RateLimiter()
+# authors and genres, kept in memory
+reference_data = ReferenceData()
+search_index = SearchIndex()
+main = Blueprint('main', __name__, cli_group=None)
+# threads running the independent queries of a page at the same time;
+# under the gevent workers they are greenlets
+query_pool = ThreadPoolExecutor(max_workers=8)
+
+
+# Creates the app. The Mongo client only connects on its first query,
+# so an app created before the server forks its workers is safe to use
+# in each of them
+def create_app(config=None):
+    app = Flask(__name__)
+
+    # eviroment variables
+    app.config['MONGO_DBNAME'] = os.environ.get('MONGODB_NAME')
+    app.config['MONGO_URI'] = os.environ.get('MONGO_URI')
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
+    app.config['BOOKS_PER_PAGE'] = int(os.environ.get('BOOKS_PER_PAGE', 20))
+    app.config['COMMENTS_PER_PAGE'] = int(
+        os.environ.get('COMMENTS_PER_PAGE', 10))
+    app.config['SEARCH_INDEX_MAX_AGE'] = int(
+        os.environ.get('SEARCH_INDEX_MAX_AGE', 300))
+
+    app.config['CACHE_TYPE'] = os.environ.get('CACHE_TYPE', 'lru')
+    app.config['CACHE_TTL'] = int(os.environ.get('CACHE_TTL', 300))
+    app.config['CACHE_REDIS_URL'] = os.environ.get('CACHE_REDIS_URL')
+    app.config['STATS_MAX_AGE'] = int(os.environ.get('STATS_MAX_AGE', 60))
+    app.config['FRAGMENT_CACHE_SIZE'] = int(
+        os.environ.get('FRAGMENT_CACHE_SIZE', 5000))
+    # directory of the compiled templates, shared by the workers and kept
+    # between restarts (a directory in the system temp dir by default)
+    app.config['JINJA_CACHE_DIR'] = os.environ.get('JINJA_CACHE_DIR')
+
+    # Mongo connection pool of each worker process, and how long to wait
+    # for a free connection, a server or an answer before failing
+    app.config['MONGO_MAX_POOL_SIZE'] = int(
+        os.environ.get('MONGO_MAX_POOL_SIZE', 50))
+    app.config['MONGO_MIN_POOL_SIZE'] = int(
+        os.environ.get('MONGO_MIN_POOL_SIZE', 0))
+    app.config['MONGO_WAIT_QUEUE_TIMEOUT_MS'] = int(
+        os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', 2000))
+    app.config['MONGO_SERVER_SELECTION_TIMEOUT_MS'] = int(
+        os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000))
+    app.config['MONGO_CONNECT_TIMEOUT_MS'] = int(
+        os.environ.get('MONGO_CONNECT_TIMEOUT_MS', 5000))
+    app.config['MONGO_SOCKET_TIMEOUT_MS'] = int(
+        os.environ.get('MONGO_SOCKET_TIMEOUT_MS', 20000))
+    app.config['MONGO_RETRY_WRITES'] = (
+        os.environ.get('MONGO_RETRY_WRITES', 'true').lower() == 'true')
+    # read preference of the book lists, authors, genres and stats
+    app.config['MONGO_LISTING_READ_PREFERENCE'] = os.environ.get(
+        'MONGO_LISTING_READ_PREFERENCE', 'primary')
+    app.config['METRICS_SLOW_REQUEST_MS'] = int(
+        os.environ.get('SLOW_REQUEST_MS', 500))
+    # the authors and genres kept in memory follow a change stream, or
+    # are reloaded every REFERENCE_POLL_SECONDS when change streams are
+    # not available
+    app.config['REFERENCE_CHANGE_STREAMS'] = (
+        os.environ.get('REFERENCE_CHANGE_STREAMS', 'true').lower() == 'true')
+    app.config['REFERENCE_POLL_SECONDS'] = int(
+        os.environ.get('REFERENCE_POLL_SECONDS', 30))
 
-# eviroment variables
-app.config['MONGO_DBNAME'] = os.environ.get('MONGODB_NAME')
-app.config['MONGO_URI'] = os.environ.get('MONGO_URI')
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
+    # requests allowed per client IP and for all the clients of a worker
+    # (of all the workers with RATE_LIMIT_STORAGE=redis) on the routes
+    # writing votes and comments or searching the books
+    app.config['RATE_LIMIT_ENABLED'] = (
+        os.environ.get('RATE_LIMIT_ENABLED', 'true').lower() == 'true')
+    app.config['RATE_LIMIT_STORAGE'] = os.environ.get(
+        'RATE_LIMIT_STORAGE', 'memory')
+    app.config['RATE_LIMIT_REDIS_URL'] = os.environ.get(
+        'RATE_LIMIT_REDIS_URL', os.environ.get('CACHE_REDIS_URL'))
+    app.config['RATE_LIMIT_VOTES'] = os.environ.get(
+        'RATE_LIMIT_VOTES', '10/minute')
+    app.config['RATE_LIMIT_VOTES_GLOBAL'] = os.environ.get(
+        'RATE_LIMIT_VOTES_GLOBAL', '20/second')
+    app.config['RATE_LIMIT_COMMENTS'] = os.environ.get(
+        'RATE_LIMIT_COMMENTS', '5/minute')
+    app.config['RATE_LIMIT_COMMENTS_GLOBAL'] = os.environ.get(
+        'RATE_LIMIT_COMMENTS_GLOBAL', '10/second')
+    app.config['RATE_LIMIT_SEARCH'] = os.environ.get(
+        'RATE_LIMIT_SEARCH', '30/minute')
+    app.config['RATE_LIMIT_SEARCH_GLOBAL'] = os.environ.get(
+        'RATE_LIMIT_SEARCH_GLOBAL', '30/second')
+    app.config['RATE_LIMIT_BEST_BOOKS'] = os.environ.get(
+        'RATE_LIMIT_BEST_BOOKS', '30/minute')
+    app.config['RATE_LIMIT_BEST_BOOKS_GLOBAL'] = os.environ.get(
+        'RATE_LIMIT_BEST_BOOKS_GLOBAL', '30/second')
+    # requests of these routes served at once by a worker while MongoDB
+    # answers slower than SHED_LATENCY_MS on average
+    app.config['SHED_LATENCY_MS'] = int(
+        os.environ.get('SHED_LATENCY_MS', 250))
+    app.config['SHED_MAX_CONCURRENT'] = int(
+        os.environ.get('SHED_MAX_CONCURRENT', 8))
+    # proxies in front of the app setting X-Forwarded-For, so that the
+    # client IP is the one of the client. The Heroku router (on a dyno,
+    # where DYNO is set) by default
+    app.config['TRUSTED_PROXIES'] = int(
+        os.environ.get('TRUSTED_PROXIES', 1 if 'DYNO' in os.environ else 0))
 
-mongo = PyMongo(app)
+    if config:
+        app.config.update(config)
 
+    if app.config['JINJA_CACHE_DIR']:
+        os.makedirs(app.config['JINJA_CACHE_DIR'], exist_ok=True)
+    app.jinja_options = dict(
+        app.jinja_options,
+        bytecode_cache=FileSystemBytecodeCache(app.config['JINJA_CACHE_DIR'])
+    )
+    fragment_cache.max_entries = app.config['FRAGMENT_CACHE_SIZE']
+    # the listeners count and time the Mongo commands of each request and
+    # follow the latency of MongoDB
+    mongo.init_app(
+        app,
+        maxPoolSize=app.config['MONGO_MAX_POOL_SIZE'],
+        minPoolSize=app.config['MONGO_MIN_POOL_SIZE'],
+        waitQueueTimeoutMS=app.config['MONGO_WAIT_QUEUE_TIMEOUT_MS'],
+        serverSelectionTimeoutMS=app.config[
+            'MONGO_SERVER_SELECTION_TIMEOUT_MS'],
+        connectTimeoutMS=app.config['MONGO_CONNECT_TIMEOUT_MS'],
+        socketTimeoutMS=app.config['MONGO_SOCKET_TIMEOUT_MS'],
+        retryWrites=app.config['MONGO_RETRY_WRITES'],
+        event_listeners=[request_metrics.listener,
+                         rate_limiter.latency_listener]
+    )
+    assets.init_app(app)
+    page_cache.init_app(app, lambda: mongo.db)
+    request_metrics.init_app(app)
+    rate_limiter.init_app(app)
+    if app.config['TRUSTED_PROXIES']:
+        app.wsgi_app = ProxyFix(app.wsgi_app,
+                                x_for=app.config['TRUSTED_PROXIES'])
+    reference_data.init_app(app, lambda: mongo.db)
+    reference_data.on_change = lambda collection: page_cache.invalidate(
+        collection, "stats")
+    search_index.max_age = app.config['SEARCH_INDEX_MAX_AGE']
+    app.register_blueprint(main)
+    return app
+
+
+# read preferences by the name used in MONGO_LISTING_READ_PREFERENCE
+READ_PREFERENCES = {
+    "primary": ReadPreference.PRIMARY,
+    "primaryPreferred": ReadPreference.PRIMARY_PREFERRED,
+    "secondary": ReadPreference.SECONDARY,
+    "secondaryPreferred": ReadPreference.SECONDARY_PREFERRED,
+    "nearest": ReadPreference.NEAREST
+}
+
+
+# Database used by the book lists and the stats, which can read from the
+# secondaries of a replica set to take load off the primary. Pages read
+# right after a write (the book page, the edit forms) use mongo.db, as
+# do the stats helpers when called outside of the app, e.g. by scripts
+def listing_db():
+    if not has_app_context():
+        return mongo.db
+    return mongo.db.client.get_database(
+        mongo.db.name,
+        read_preference=READ_PREFERENCES[
+            current_app.config['MONGO_LISTING_READ_PREFERENCE']]
+    )
 
-# Creates a visual 5 stars scale from array of ratings
+
+# Star scale shown for books that have not been rated yet
+NO_RATING_STARS = '✩✩✩✩✩'
+
+# scores a vote can give, the slots of the star histogram
+RATING_SCORES = range(1, 6)
+
+
+# Creates a visual 5 stars scale from a mean rating
+def stars_from_mean(mean_rating):
+    star_rating = ""
+    count = 0
+    while count < 5:
+        if mean_rating < count+0.5:
+            star_rating += '☆'
+        else:
+            star_rating += '★'
+        count += 1
+    return star_rating
+
+
+# Returns the visual 5 stars scale stored on the book
 def star_rating(book):
-    rating = [rating_list[0] for rating_list in book['book_rating']]
-    if rating == []:
-        star_rating = '✩✩✩✩✩'
+    return book.get('star_rating', NO_RATING_STARS)
+
+
+# Computes the rating aggregates stored on each book from its star
+# histogram, the number of votes given to each score from 1 to 5
+def histogram_aggregates(rating_histogram):
+    rating_histogram = dict(
+        {str(star): 0 for star in range(1, 6)},
+        **{str(star): int(count) for star, count in rating_histogram.items()}
+    )
+    rating_count = sum(rating_histogram.values())
+    rating_sum = sum(int(star) * count
+                     for star, count in rating_histogram.items())
+    if rating_count == 0:
+        mean_rating = 0
+        stars = NO_RATING_STARS
     else:
-        mean_rating = mean(rating)
-        star_rating = ""
-        count = 0
-        while count < 5:
-            if mean_rating < count+0.5:
-                star_rating += '☆'
-            else:
-                star_rating += '★'
-            count += 1
-    return star_rating
+        mean_rating = rating_sum / rating_count
+        stars = stars_from_mean(mean_rating)
+    return {
+        "rating_sum": rating_sum,
+        "rating_count": rating_count,
+        "rating_mean": mean_rating,
+        "rating_histogram": rating_histogram,
+        "star_rating": stars
+    }
+
+
+# Computes the rating aggregates from a list of [score, date] ratings,
+# the format books stored their votes in before the histogram
+def rating_aggregates(book_rating):
+    rating_histogram = {}
+    for rating_list in book_rating:
+        star = str(rating_list[0])
+        rating_histogram[star] = rating_histogram.get(star, 0) + 1
+    return histogram_aggregates(rating_histogram)
+
+
+# Builds the update pipeline that counts a new rating in the histogram
+# and refreshes the rating aggregates in a single atomic write. The date
+# of the vote is only kept in the daily rating buckets
+def rating_update(new_rating):
+    histogram_field = f"rating_histogram.{new_rating}"
+    return [
+        {"$set": {
+            "rating_sum": {"$add": [{"$ifNull": ["$rating_sum", 0]},
+                                    new_rating]},
+            "rating_count": {"$add": [{"$ifNull": ["$rating_count", 0]}, 1]},
+            histogram_field: {"$add": [
+                {"$ifNull": ["$" + histogram_field, 0]}, 1]},
+            "updated_at": "$$NOW"
+        }},
+        {"$set": {
+            "rating_mean": {"$divide": ["$rating_sum", "$rating_count"]}
+        }},
+        {"$set": {
+            "star_rating": {"$concat": [
+                {"$cond": [{"$lt": ["$rating_mean", count+0.5]}, '☆', '★']}
+                for count in range(5)
+            ]}
+        }}
+    ]
 
 
 # Add the attribute book_short_description
@@ -54,205 +325,594 @@ def short_description(book):
     return book_short_description
 
 
-# Turns the cursor object into a string
-def cursor_to_list(cursor_books):
-    books = list(cursor_books)
-    for book in books:
+# Returns the datetime of midnight of the given day, used to bucket ratings
+def rating_day(day):
+    return datetime.combine(day, time.min)
+
+
+# Computes the daily rating buckets of a book from its rating list
+def daily_rating_buckets(book):
+    buckets = {}
+    for rating, rating_date in book.get("book_rating", []):
+        day = datetime.strptime(rating_date, "%d-%b-%Y")
+        bucket = buckets.setdefault(day, {
+            "book_id": book["_id"],
+            "day": day,
+            "rating_sum": 0,
+            "rating_count": 0
+        })
+        bucket["rating_sum"] += rating
+        bucket["rating_count"] += 1
+    return list(buckets.values())
+
+
+# Counts the votes of the rating list of a book in its daily buckets.
+# The votes of a day are added when its bucket holds fewer votes than
+# the list: the list of a book voted before the buckets, or only given
+# its aggregates by backfill-ratings, was never counted in them, while
+# the days counted when the votes were cast, or by an earlier call, are
+# left as they are
+def bucket_rating_list(book):
+    buckets = daily_rating_buckets(book)
+    if not buckets:
+        return
+    counted = {
+        bucket["day"]: bucket["rating_count"]
+        for bucket in mongo.db.daily_ratings.find(
+            {"book_id": book["_id"],
+             "day": {"$in": [bucket["day"] for bucket in buckets]}},
+            {"day": 1, "rating_count": 1})
+    }
+    missing = [bucket for bucket in buckets
+               if counted.get(bucket["day"], 0) < bucket["rating_count"]]
+    if missing:
+        mongo.db.daily_ratings.bulk_write([
+            UpdateOne({"book_id": bucket["book_id"], "day": bucket["day"]},
+                      {"$inc": {"rating_sum": bucket["rating_sum"],
+                                "rating_count": bucket["rating_count"]}},
+                      upsert=True)
+            for bucket in missing
+        ], ordered=False)
+
+
+# Removes the rating list of a book. The votes cast since the list
+# stopped growing are only counted in the stored histogram, so a book
+# with rating aggregates keeps them, and a book without aggregates,
+# which has not been voted since, gets them from its list. The votes of
+# the list are then counted in the daily buckets. The book is only
+# written while its list is unchanged. Returns whether the book was
+# compacted
+def compact_rating_list(book):
+    book_rating = book["book_rating"]
+    if "rating_count" in book:
+        result = mongo.db.books.update_one(
+            {"_id": book["_id"], "book_rating": book_rating},
+            {"$unset": {"book_rating": ""}}
+        )
+    else:
+        result = mongo.db.books.update_one(
+            {"_id": book["_id"], "book_rating": book_rating,
+             "rating_count": {"$exists": False}},
+            {"$set": dict(rating_aggregates(book_rating),
+                          updated_at=datetime.utcnow()),
+             "$unset": {"book_rating": ""}}
+        )
+    if result.modified_count == 0:
+        return False
+    bucket_rating_list(book)
+    return True
+
+
+# indexes needed by the queries of the app, by collection
+INDEXES = {
+    "books": [
+        ([("book_title", TEXT), ("book_author", TEXT)],
+         {"name": "book_search"}),
+        ([("book_title", ASCENDING), ("book_author", ASCENDING)],
+         {"unique": True}),
+        ([("book_author", ASCENDING), ("_id", ASCENDING)], {}),
+        ([("book_genre", ASCENDING), ("_id", ASCENDING)], {}),
+        ([("rating_mean", DESCENDING)], {}),
+        ([("rating_count", DESCENDING)], {})
+    ],
+    "authors": [
+        ([("author_name", ASCENDING)], {"unique": True})
+    ],
+    "genres": [
+        ([("genre_name", ASCENDING)], {"unique": True})
+    ],
+    "daily_ratings": [
+        ([("book_id", ASCENDING), ("day", ASCENDING)], {"unique": True}),
+        ([("day", ASCENDING)], {})
+    ],
+    "comments": [
+        ([("book_id", ASCENDING), ("created_at", ASCENDING),
+          ("_id", ASCENDING)], {})
+    ],
+    "stats_groups": [
+        ([("field", ASCENDING), ("name", ASCENDING)], {"unique": True})
+    ]
+}
+
+
+# Names of the text indexes of a collection other than the text index
+# given. MongoDB allows a single text index per collection, so these
+# have to be dropped before it is created
+def conflicting_text_indexes(collection, keys, name):
+    fields = {field for field, kind in keys if kind == TEXT}
+    return [
+        index_name
+        for index_name, index in collection.index_information().items()
+        if any(kind == TEXT for field, kind in index["key"])
+        and (index_name != name
+             or set(index.get("weights", fields)) != fields)
+    ]
+
+
+# Some of the values of the keys of a unique index shared by several
+# documents, which keep the index from being created
+def duplicate_keys(collection, keys, limit=5):
+    return list(collection.aggregate([
+        {"$group": {
+            "_id": {field: "$" + field for field, direction in keys},
+            "count": {"$sum": 1}
+        }},
+        {"$match": {"count": {"$gt": 1}}},
+        {"$limit": limit}
+    ], allowDiskUse=True))
+
+
+# Creates the indexes of the app, skipping the ones already present.
+# A text index left by an older version of the app is replaced. A
+# unique index is not created while documents share its keys: these
+# are returned as warnings, so that a release is not blocked until the
+# duplicates are merged. Returns the errors and the warnings of the
+# indexes that could not be created
+def init_indexes(indexes=INDEXES):
+    errors = []
+    warnings = []
+    for collection_name, collection_indexes in indexes.items():
+        collection = mongo.db[collection_name]
+        for keys, options in collection_indexes:
+            try:
+                if any(kind == TEXT for field, kind in keys):
+                    for name in conflicting_text_indexes(
+                            collection, keys, options["name"]):
+                        collection.drop_index(name)
+                elif options.get("unique") and not any(
+                        index["key"] == keys for index in
+                        collection.index_information().values()):
+                    duplicates = duplicate_keys(collection, keys)
+                    if duplicates:
+                        warnings.append(
+                            f"{collection_name} {keys}: documents share the"
+                            f" same keys, e.g. {duplicates[0]['_id']}"
+                            f" ({duplicates[0]['count']} documents)")
+                        continue
+                collection.create_index(keys, **options)
+            except OperationFailure as error:
+                errors.append(f"{collection_name} {keys}: {error}")
+    return errors, warnings
+
+
+# Adds delta to the number of books of an author, creating the author
+# when a book is added for an author that is not in the DB yet
+def count_author_book(author_name, delta):
+    mongo.db.authors.update_one(
+        {"author_name": author_name},
+        {"$inc": {"book_count": delta}},
+        upsert=delta > 0
+    )
+
+
+# fields of a book shown in the book lists
+LIST_PROJECTION = {
+    "updated_at": 1,
+    "book_title": 1,
+    "book_author": 1,
+    "book_description": 1,
+    "rating_mean": 1,
+    "rating_count": 1,
+    "star_rating": 1
+}
+
+
+# Renders the card of a book in the book lists. Cards are cached by book
+# id and time of the last update of the book, so a card is only rendered
+# again after the book changes
+@main.app_template_global()
+def book_card(book, show_author=True):
+    key = f"{book['_id']}:{book.get('updated_at')}:{show_author}"
+    card = fragment_cache.get(key)
+    if card is None:
+        template = current_app.jinja_env.get_template('book_card.html')
+        card = Markup(template.render(book=book, show_author=show_author))
+        fragment_cache.set(key, card)
+    return card
+
+
+# Renders a template as a stream: the start of the page is sent while
+# the rows of a long listing are still being read and rendered
+def stream_template(template_name, **context):
+    current_app.update_template_context(context)
+    template = current_app.jinja_env.get_template(template_name)
+    return Response(stream_with_context(template.generate(context)))
+
+
+# Yields the books with the attributes used by the book lists
+def iter_books(cursor_books):
+    for book in cursor_books:
         book['star_rating'] = star_rating(book)
         book['book_short_description'] = short_description(book)
-    return books
+        yield book
+
+
+# Returns a page of the books matching the query, in insertion order,
+# starting after the book id passed as "after" in the query string,
+# and the id to continue from (None on the last page)
+def books_page(query):
+    page_size = current_app.config['BOOKS_PER_PAGE']
+    after = request.args.get('after')
+    if after and ObjectId.is_valid(after):
+        query = dict(query, _id={"$gt": ObjectId(after)})
+    books = list(
+        listing_db().books.find(query, LIST_PROJECTION)
+        .sort("_id", 1)
+        .limit(page_size + 1)
+    )
+    next_after = None
+    if len(books) > page_size:
+        books = books[:page_size]
+        next_after = books[-1]["_id"]
+    return iter_books(books), next_after
+
+
+# Position of a comment in the comments of its book, passed as "after"
+# to continue the list after it. MongoDB returns naive UTC datetimes,
+# read by timestamp() as local time unless they are marked as UTC
+def comment_cursor(comment):
+    created_at = comment["created_at"].replace(tzinfo=timezone.utc)
+    created_at = int(created_at.timestamp() * 1000)
+    return f"{created_at}-{comment['_id']}"
+
+
+# Returns a page of the comments of a book, oldest first, starting after
+# the comment cursor passed as "after" in the query string, and the
+# cursor to continue from (None on the last page)
+def comments_page(book_id):
+    page_size = current_app.config['COMMENTS_PER_PAGE']
+    query = {"book_id": book_id}
+    created_at, _, comment_id = request.args.get('after', '').partition('-')
+    if created_at.isdigit() and ObjectId.is_valid(comment_id):
+        created_at = datetime.utcfromtimestamp(int(created_at) / 1000)
+        query["$or"] = [
+            {"created_at": {"$gt": created_at}},
+            {"created_at": created_at, "_id": {"$gt": ObjectId(comment_id)}}
+        ]
+    comments = list(
+        mongo.db.comments.find(query)
+        .sort([("created_at", 1), ("_id", 1)])
+        .limit(page_size + 1)
+    )
+    next_after = None
+    if len(comments) > page_size:
+        comments = comments[:page_size]
+        next_after = comment_cursor(comments[-1])
+    return comments, next_after
+
 
+# fields of a book needed by the stats page rankings
+RANKING_PROJECTION = {
+    "book_title": 1,
+    "book_author": 1,
+    "rating_mean": 1,
+    "rating_count": 1,
+    "star_rating": 1
+}
 
-# returns a list of the 10 most rated books
+
+# Turns a book projected with RANKING_PROJECTION into a ranking entry
+def ranking_entry(book):
+    return {
+        "_id": book["_id"],
+        "book_title": book["book_title"],
+        "book_author": book["book_author"],
+        "book_rating": round(book.get("rating_mean", 0), 1),
+        "book_votes": book.get("rating_count", 0),
+        "book_stars": star_rating(book)
+    }
+
+
+# Runs independent queries at the same time and returns their results
+# in the order of the functions
+def run_concurrently(*functions):
+    app = current_app._get_current_object()
+
+    def in_app_context(function):
+        def run():
+            with app.app_context():
+                return function()
+        return run
+
+    futures = [
+        query_pool.submit(request_metrics.track(in_app_context(function)))
+        for function in functions
+    ]
+    return [future.result() for future in futures]
+
+
+# returns a list of the 10 most rated books, sorted by MongoDB
 def best_ten_books():
-    best_book_list = []
-    books = list(mongo.db.books.find())
-    for book in books:
-        mean_rating = 0
-        if book['book_rating'] != []:
-            mean_rating = round(
-                mean(
-                    [rating_list[0] for rating_list in book['book_rating']]
-                ),
-                1
-            )
-        best_book_list.append({
-            "_id": book["_id"],
-            "book_title": book["book_title"],
-            "book_author": book["book_author"],
-            "book_rating": mean_rating,
-            "book_stars": star_rating(book)
-        })
-    best_books = sorted(
-        best_book_list, key=lambda x: x["book_rating"], reverse=True)[:10]
-    return best_books
+    books = listing_db().books.find(
+        {}, RANKING_PROJECTION
+    ).sort("rating_mean", -1).limit(10)
+    return [ranking_entry(book) for book in books]
+
+
+# returns the book that was voted most times
+def most_voted_book():
+    book = listing_db().books.find_one(
+        {}, RANKING_PROJECTION, sort=[("rating_count", -1)])
+    if book:
+        return ranking_entry(book)
 
 
 # updates book ratings
-@app.route('/insert_rating/<book_id>', methods=["POST"])
+@main.route('/insert_rating/<book_id>', methods=["POST"])
+@rate_limiter.limit("votes")
 def insert_rating(book_id):
-    books = mongo.db.books
-    book = books.find_one({"_id": ObjectId(book_id)})
     # new rating
-    new_rating = int(request.form.get('rating'))
-    rating_date = date.today().strftime("%d-%b-%Y")
-    new_rating_list = [new_rating, rating_date]
-    # adds new rating to the rating list
-    book_rating = list(book['book_rating'])
-    book_rating.append(new_rating_list)
-    # udpates mongoDB
-    books.update_one({'_id': ObjectId(book_id)},
-                     {'$set': {
-                         "book_rating": book_rating
-                     }})
-    return redirect(url_for("get_book", book_id=book_id))
+    new_rating = request.form.get('rating', type=int)
+    if new_rating not in RATING_SCORES:
+        return "The rating must be a score from 1 to 5.", 400
+    # counts the new rating in the histogram and updates the aggregates
+    result = mongo.db.books.update_one({'_id': ObjectId(book_id)},
+                                       rating_update(new_rating))
+    if result.matched_count != 1:
+        return "This book does not exist.", 404
+    # counts the rating in the bucket of the current day
+    mongo.db.daily_ratings.update_one(
+        {"book_id": ObjectId(book_id), "day": rating_day(date.today())},
+        {"$inc": {"rating_sum": new_rating, "rating_count": 1}},
+        upsert=True
+    )
+    page_cache.invalidate("books", f"book:{book_id}")
+    return redirect(url_for("main.get_book", book_id=book_id))
 
 
 # gets all books in DB
-@app.route('/')
-@app.route('/get_books')
+@main.route('/')
+@main.route('/get_books')
+@page_cache.cached("books")
 def get_books():
-    books_cursor = mongo.db.books.find()
-    books = cursor_to_list(books_cursor)
-    return render_template('books.html', books=books)
+    books, next_after = books_page({})
+    return stream_template('books.html', books=books, next_after=next_after)
 
 
 # gets the user to the store section
-@app.route('/store/<book_id>')
+@main.route('/store/<book_id>')
 def store(book_id):
     book = mongo.db.books.find_one({"_id": ObjectId(book_id)})
     return render_template('buy.html', book=book)
 
 
 # gets a spefic book in DB
-@app.route('/book/<book_id>')
+@main.route('/book/<book_id>')
+@page_cache.cached(lambda book_id: f"book:{book_id}", "catalogue")
 def get_book(book_id):
-    book = mongo.db.books.find_one({"_id": ObjectId(book_id)})
+    # fetches the book and its author book count in a single query,
+    # leaving out the comments embedded by older versions of the app
+    book = mongo.db.books.aggregate([
+        {"$match": {"_id": ObjectId(book_id)}},
+        {"$project": {"book_comments": 0}},
+        {"$lookup": {
+            "from": "authors",
+            "localField": "book_author",
+            "foreignField": "author_name",
+            "as": "author"
+        }}
+    ]).next()
     book["star_rating"] = star_rating(book)
-    list_by_author = list(mongo.db.books.find(
-        {"book_author": book["book_author"]}))
-    if len(list_by_author) > 1:
-        return render_template('book.html', book=book, author_list=True)
-    else:
-        return render_template('book.html', book=book)
+    author_book_count = 0
+    if book["author"]:
+        author_book_count = book["author"][0].get("book_count", 0)
+    # the first comments are shown with the book, the next ones are
+    # loaded by the page when asked
+    comments, next_after = comments_page(book["_id"])
+    return render_template('book.html',
+                           book=book,
+                           comments=comments,
+                           next_after=next_after,
+                           author_book_count=author_book_count,
+                           author_list=author_book_count > 1)
+
+
+# JSON page of the comments of a book, oldest first
+@main.route('/api/books/<book_id>/comments')
+@page_cache.cached(lambda book_id: f"comments:{book_id}", compress=True)
+def api_book_comments(book_id):
+    comments, next_after = comments_page(ObjectId(book_id))
+    return jsonify(
+        comments=[
+            {
+                "text": comment["text"],
+                "author": comment["author"],
+                "created_at": comment["created_at"].isoformat()
+            }
+            for comment in comments
+        ],
+        next_after=next_after
+    )
 
 # when book is not found in DB, user is redirected
-@app.route('/book_not_found/<book_input>')
+@main.route('/book_not_found/<book_input>')
 def get_book_error(book_input):
+    books, next_after = books_page({})
     return render_template('books.html',
-                           books=mongo.db.books.find(),
+                           books=books,
+                           next_after=next_after,
                            error_message=True,
                            book_input=book_input.title())
 
 # based on user imputed a search is carried on in DB
-@app.route('/search_book/', methods=["POST"])
+@main.route('/search_book/', methods=["POST"])
 def search_book():
     book_input = request.form.get('book_input')
-    book = mongo.db.books.find_one({'$text': {'$search': book_input}})
-    if book:
-        book_id = book["_id"]
-        return redirect(url_for("get_book", book_id=book_id))
-    else:
-        return redirect(url_for("get_book_error", book_input=book_input))
+    return redirect(url_for("main.search_results", q=book_input))
+
+
+# loads the title and author of every book for the search index
+def search_index_books():
+    return mongo.db.books.find({}, {"book_title": 1, "book_author": 1})
+
+
+# lists the books matching the search, best match first. A single match
+# leads straight to the book; when nothing matches, the search is
+# retried with the misspelled words corrected
+@main.route('/search')
+@rate_limiter.limit("search")
+def search_results():
+    book_input = request.args.get('q', '')
+    if not book_input.strip():
+        return redirect(url_for("main.get_books"))
+    page = max(request.args.get('page', 1, type=int), 1)
+    page_size = current_app.config['BOOKS_PER_PAGE']
+    books = list(
+        mongo.db.books.find(
+            {'$text': {'$search': book_input}},
+            dict(LIST_PROJECTION, score={'$meta': 'textScore'})
+        )
+        .sort([('score', {'$meta': 'textScore'})])
+        .skip((page - 1) * page_size)
+        .limit(page_size + 1)
+    )
+    corrected_input = None
+    if books == [] and page == 1:
+        search_index.ensure_loaded(search_index_books)
+        corrected_input, matches = search_index.fuzzy_search(
+            book_input, limit=page_size)
+        books = list(mongo.db.books.find(
+            {"_id": {"$in": [match["_id"] for match in matches]}},
+            LIST_PROJECTION
+        ))
+        # the books are listed in the order of the matches, best first
+        ranks = {match["_id"]: rank for rank, match in enumerate(matches)}
+        books.sort(key=lambda book: ranks[book["_id"]])
+    if books == []:
+        return redirect(url_for("main.get_book_error", book_input=book_input))
+    if len(books) == 1 and page == 1 and corrected_input is None:
+        return redirect(url_for("main.get_book", book_id=books[0]["_id"]))
+    return render_template('search_results.html',
+                           books=iter_books(books[:page_size]),
+                           book_input=book_input,
+                           corrected_input=corrected_input,
+                           page=page,
+                           has_next=len(books) > page_size)
+
+
+# suggests books whose title or author words start with the words typed
+@main.route('/api/autocomplete')
+def autocomplete():
+    search_index.ensure_loaded(search_index_books)
+    suggestions = search_index.complete(request.args.get('q', ''))
+    return jsonify([
+        dict(suggestion, _id=str(suggestion["_id"]))
+        for suggestion in suggestions
+    ])
 
 # directs to list of books by genre selected
-@app.route('/get_books_genre/<genre_name>')
+@main.route('/get_books_genre/<genre_name>')
 def get_books_by_genre(genre_name):
-    books_cursor = mongo.db.books.find({"book_genre": genre_name})
-    books = cursor_to_list(books_cursor)
-    return render_template(
+    books, next_after = books_page({"book_genre": genre_name})
+    return stream_template(
         'get_books_genre.html',
         books=books,
+        next_after=next_after,
         genre=genre_name
     )
 
 # directs to list of books by author selected
-@app.route('/get_books_author/<author_name>')
+@main.route('/get_books_author/<author_name>')
 def get_books_by_author(author_name):
-    books_cursor = mongo.db.books.find({"book_author": author_name})
-    books = cursor_to_list(books_cursor)
-    return render_template(
+    books, next_after = books_page({"book_author": author_name})
+    return stream_template(
         'get_books_author.html',
         books=books,
+        next_after=next_after,
         author=author_name
     )
 
 # directs to list of authors
-@app.route('/get_authors')
+@main.route('/get_authors')
+@page_cache.cached("authors")
 def get_authors():
-    return render_template('authors.html', authors=mongo.db.authors.find())
+    return stream_template('authors.html',
+                           authors=reference_data.authors())
 
 # directs to list of genres
-@app.route('/get_genres')
+@main.route('/get_genres')
+@page_cache.cached("genres")
 def get_genres():
-    return render_template('genres.html', genres=mongo.db.genres.find())
+    return stream_template('genres.html',
+                           genres=reference_data.genres())
 
 # directs to about page
-@app.route('/about')
+@main.route('/about')
 def about():
     return render_template('about.html')
 
-# directs to stats page after defining current dates, top-rated and top-voted books
-@app.route('/stats')
+# directs to stats page, showing the figures of the stats snapshot
+@main.route('/stats')
+@page_cache.cached("stats")
 def stats():
-    books = list(mongo.db.books.find())
-    book_list = []
-    for book in books:
-        mean_rating = 0
-        if book['book_rating'] != []:
-            mean_rating = round(
-                mean(
-                    [rating_list[0] for rating_list in book['book_rating']]
-                ),
-                1
-            )
-        votes = len(book["book_rating"])
-        book_list.append({
-            "_id": book["_id"],
-            "book_title": book["book_title"],
-            "book_author": book["book_author"],
-            "book_rating": mean_rating,
-            "book_votes": votes
-        })
-    top_rated = max(book_list, key=lambda x: x["book_rating"])
-    top_voted = max(book_list, key=lambda x: x["book_votes"])
+    snapshot = stats_snapshot()
     return render_template('stats.html',
-                           top_rated=top_rated,
-                           top_voted=top_voted,
-                           authors=mongo.db.authors.find(),
-                           genres=mongo.db.genres.find(),
-                           best_ten_books=best_ten_books(),
-                           top_rated_today=best_book_today(),
+                           top_rated=snapshot["top_rated"],
+                           top_voted=snapshot["top_voted"],
+                           authors=reference_data.authors(),
+                           genres=reference_data.genres(),
+                           best_ten_books=snapshot["best_ten_books"],
+                           top_rated_today=snapshot["top_rated_today"],
+                           top_rated_week=snapshot["top_rated_week"],
+                           computed_at=snapshot["computed_at"],
+                           max_age=current_app.config['STATS_MAX_AGE'],
                            current_date=date.today().strftime("%d %B %Y"))
 
 
 # renders add_book.html
-@app.route('/add_book')
+@main.route('/add_book')
 def add_book():
     return render_template('add_book.html',
-                           genres=mongo.db.genres.find(),
-                           authors=mongo.db.authors.find())
+                           genres=reference_data.genres(),
+                           authors=reference_data.authors())
 
 # directs to add_genre page
-@app.route('/add_genre')
+@main.route('/add_genre')
 def add_genre():
     return render_template('add_genre.html')
 
 # directs to add_author page
-@app.route('/add_author')
+@main.route('/add_author')
 def add_author():
     return render_template('add_author.html')
 
 
+# message shown when a book of the same title and author is in the DB
+def book_exists_message(book):
+    return (f"{book['book_title'].title()}"
+            f" by {book['book_author'].title()}"
+            " already exists in the database!")
+
+
 # Add a new book in DB
-@app.route('/insert_book', methods=["POST"])
+@main.route('/insert_book', methods=["POST"])
 def insert_book():
     books = mongo.db.books
     new_book = request.form.to_dict()
     book_count = books.count_documents(
         {
             "book_title": new_book['book_title'].lower(),
-            "book_author": new_book['book_author']
+            "book_author": new_book['book_author'].lower()
         },
         limit=1
     )
@@ -261,32 +921,38 @@ def insert_book():
         new_book['book_author'] = new_book['book_author'].lower()
         new_book['book_genre'] = new_book['book_genre'].lower()
         new_book['password'] = new_book['password'].lower()
-        new_book['book_rating'] = []
-        books.insert_one(new_book)
-        flash(
-            f"Thanks for adding {new_book['book_title'].title()}"
-            " to our database!"
-            f"Please write down your password {new_book['password']}. "
-            "You will need it to edit or delete this book from our database"
-        )
-    else:
-        flash(
-            f"{new_book['book_title'].title()}"
-            " by {new_book['book_author'].title()}"
-            " already exists in the database!"
-        )
-    return redirect(url_for("get_books"))
+        new_book.update(histogram_aggregates({}))
+        new_book['updated_at'] = datetime.utcnow()
+        try:
+            books.insert_one(new_book)
+        except DuplicateKeyError:
+            # added by another request since the check
+            book_count = 1
+        else:
+            count_author_book(new_book['book_author'], 1)
+            search_index.add(new_book)
+            page_cache.invalidate("books", "catalogue", "authors")
+            flash(
+                f"Thanks for adding {new_book['book_title'].title()}"
+                " to our database!"
+                f"Please write down your password {new_book['password']}. "
+                "You will need it to edit or delete this book from our "
+                "database"
+            )
+    if book_count:
+        flash(book_exists_message(new_book))
+    return redirect(url_for("main.get_books"))
 
 
 # directs to the delete page
-@app.route('/delete_book_sure/<book_id>')
+@main.route('/delete_book_sure/<book_id>')
 def delete_book_sure(book_id):
     books = mongo.db.books
     book = books.find_one({"_id": ObjectId(book_id)})
     return render_template('delete.html', book=book)
 
 # verifies the password for delete and edit function 
-@app.route('/verify_password/<book_id>/<action>', methods=["POST"])
+@main.route('/verify_password/<book_id>/<action>', methods=["POST"])
 def verify_password(book_id, action):
     books = mongo.db.books
     book_cursor = books.find({"_id": ObjectId(book_id)})
@@ -298,13 +964,13 @@ def verify_password(book_id, action):
     if password != book_password:
         flash("This password is not correct. Try again!")
         if action == "delete":
-            return redirect(url_for("delete_book_sure", book_id=book_id))
+            return redirect(url_for("main.delete_book_sure", book_id=book_id))
     # invalid password for editing the book
         elif action == "modify":
-            return redirect(url_for("edit_book", book_id=book_id))
+            return redirect(url_for("main.edit_book", book_id=book_id))
     # valid password for deleting the book
     elif action == "delete":
-        return redirect(url_for("delete", book_id=book_id))
+        return redirect(url_for("main.delete", book_id=book_id))
     # valid password for editing the book
     elif action == "modify":
         new_details = request.form.to_dict()
@@ -312,31 +978,54 @@ def verify_password(book_id, action):
         new_author = new_details["book_author"].lower()
         new_description = new_details["book_description"]
         new_genre = new_details["book_genre"].lower()
-        books.update_one({'_id': ObjectId(book_id)},
-                            {'$set': {
-                                "book_title": new_title,
-                                "book_author": new_author,
-                                "book_genre": new_genre,
-                                "book_description": new_description
-                            }})
+        try:
+            books.update_one({'_id': ObjectId(book_id)},
+                             {'$set': {
+                                 "book_title": new_title,
+                                 "book_author": new_author,
+                                 "book_genre": new_genre,
+                                 "book_description": new_description,
+                                 "updated_at": datetime.utcnow()
+                             }})
+        except DuplicateKeyError:
+            # another book has the new title and author
+            flash(book_exists_message(new_details))
+            return redirect(url_for("main.edit_book", book_id=book_id))
+        search_index.add({
+            "_id": ObjectId(book_id),
+            "book_title": new_title,
+            "book_author": new_author
+        })
+        if new_author != book_dict["book_author"]:
+            count_author_book(book_dict["book_author"], -1)
+            count_author_book(new_author, 1)
+        page_cache.invalidate("books", "catalogue", "authors",
+                              f"book:{book_id}")
 
         flash(" All info updated!")
-        return redirect(url_for("get_book", book_id=book_id))
+        return redirect(url_for("main.get_book", book_id=book_id))
 
 
 # deletes the book selected from DB
-@app.route('/delete/<book_id>')
+@main.route('/delete/<book_id>')
 def delete(book_id):
     books = mongo.db.books
-    book_cursor = books.find({"_id": ObjectId(book_id)})
-    book_name = list(book_cursor)[0]["book_title"]
-    books.delete_one({"_id": ObjectId(book_id)})
-    flash(f"{book_name.title()} is now deleted from our database")
-    return redirect(url_for("get_books"))
+    book = books.find_one_and_delete({"_id": ObjectId(book_id)},
+                                     {"book_title": 1, "book_author": 1})
+    # only the request that actually deleted the book updates the counts
+    if book:
+        count_author_book(book["book_author"], -1)
+        search_index.remove(ObjectId(book_id))
+        mongo.db.daily_ratings.delete_many({"book_id": ObjectId(book_id)})
+        mongo.db.comments.delete_many({"book_id": ObjectId(book_id)})
+        page_cache.invalidate("books", "catalogue", f"book:{book_id}")
+        flash(f"{book['book_title'].title()}"
+              " is now deleted from our database")
+    return redirect(url_for("main.get_books"))
 
 
 # directs to the edit page
-@app.route('/edit_book/<book_id>')
+@main.route('/edit_book/<book_id>')
 def edit_book(book_id):
     books = mongo.db.books
     book_cursor = books.find({"_id": ObjectId(book_id)})
@@ -344,34 +1033,44 @@ def edit_book(book_id):
     return render_template(
         'edit_book.html',
         book=book,
-        genres=mongo.db.genres.find(),
-        authors=mongo.db.authors.find()
+        genres=reference_data.genres(),
+        authors=reference_data.authors()
     )
 
 # insert a new genre in DB if that is not present
-@app.route('/insert_genre', methods=["POST"])
+@main.route('/insert_genre', methods=["POST"])
 def insert_genre():
     genres = mongo.db.genres
     new_genre = request.form.to_dict()
+    genre = new_genre['genre_name'].lower()
     genre_count = genres.count_documents(
-        {"genre_name": new_genre['genre_name'].lower()},
+        {"genre_name": genre},
         limit=1
     )
     if genre_count == 0:
-        genres.insert_one(new_genre)
-        flash(
-            f"Thanks for adding {new_genre['genre_name'].title()}"
-            " to our database!"
-        )
-    else:
+        new_genre_document = {"genre_name": genre}
+        try:
+            genres.insert_one(new_genre_document)
+        except DuplicateKeyError:
+            # added by another request since the check
+            genre_count = 1
+        else:
+            # shown at once by this worker, the other workers get it
+            # from the change stream
+            reference_data.store("genres", new_genre_document)
+            flash(
+                f"Thanks for adding {new_genre['genre_name'].title()}"
+                " to our database!"
+            )
+    if genre_count:
         flash(
             f"The genre {new_genre['genre_name'].title()}"
             " already exists in the database!"
         )
-    return redirect(url_for("add_book"))
+    return redirect(url_for("main.add_book"))
 
 # insert a new author in DB if that is not present
-@app.route('/insert_author', methods=["POST"])
+@main.route('/insert_author', methods=["POST"])
 def insert_author():
     authors = mongo.db.authors
     new_author = request.form.to_dict()
@@ -381,24 +1080,28 @@ def insert_author():
         limit=1
     )
     if author_count == 0:
-        authors.insert_one({
-            "author_name": author
-        }
-        )
-        flash(
-            f"Thanks for adding {new_author['author_name'].title()}"
-            " to our database!"
-        )
-    else:
+        new_author_document = {"author_name": author}
+        try:
+            authors.insert_one(new_author_document)
+        except DuplicateKeyError:
+            # added by another request since the check
+            author_count = 1
+        else:
+            reference_data.store("authors", new_author_document)
+            flash(
+                f"Thanks for adding {new_author['author_name'].title()}"
+                " to our database!"
+            )
+    if author_count:
         flash(
             f"{new_author['author_name'].title()}"
             " already exists in the database!"
         )
-    return redirect(url_for("add_book"))
+    return redirect(url_for("main.add_book"))
 
 
 # directs to add a comment section
-@app.route('/comment/<book_id>')
+@main.route('/comment/<book_id>')
 def add_comment(book_id):
     book = mongo.db.books.find_one({"_id": ObjectId(book_id)})
     return render_template('add_comment.html',
@@ -406,30 +1109,29 @@ def add_comment(book_id):
 
 
 # insert a comment
-@app.route('/insert_comment/<book_id>', methods=["POST"])
+@main.route('/insert_comment/<book_id>', methods=["POST"])
+@rate_limiter.limit("comments")
 def insert_comment(book_id):
-    books = mongo.db.books
-    book_cursor = mongo.db.books.find_one({"_id": ObjectId(book_id)})
     new_comment = request.form.to_dict()
-    new_comment_list = [new_comment['book_comment'],
-                        new_comment['comment_author']]
-    book_comment_list = []
-    if 'book_comments' in list(book_cursor):
-        book_comment_list = book_cursor['book_comments']
-    book_comment_list.append(new_comment_list)
-    books.update_one({'_id': ObjectId(book_id)},
-                     {'$set': {
-                         "book_comments": book_comment_list
-                     }})
-
+    # the comment is stored on its own, so the book does not grow with
+    # its discussion
+    mongo.db.comments.insert_one({
+        "book_id": ObjectId(book_id),
+        "text": new_comment['book_comment'],
+        "author": new_comment['comment_author'],
+        "created_at": datetime.utcnow()
+    })
+    mongo.db.books.update_one({'_id': ObjectId(book_id)},
+                              {'$inc': {"comment_count": 1}})
+    page_cache.invalidate(f"book:{book_id}", f"comments:{book_id}")
     flash(
         f"Thanks {new_comment['comment_author']}!"
         "Your comment has been pubblished."
     )
-    return redirect(url_for("get_book", book_id=book_id))
+    return redirect(url_for("main.get_book", book_id=book_id))
 
 # directs to "rate a book" section 
-@app.route('/vote/<book_title>')
+@main.route('/vote/<book_title>')
 def update_rating(book_title):
     book = mongo.db.books.find_one({"book_title": book_title})
     return render_template('update_rating.html',
@@ -438,7 +1140,8 @@ def update_rating(book_title):
 
 # sorts books by rating, based on user choice of AUTHOR or GENRE,
 # and returns JSON object to client side
-@app.route('/best_books/', methods=['POST'])
+@main.route('/best_books/', methods=['POST'])
+@rate_limiter.limit("best_books")
 def best_books():
     choice_str = request.get_json()["choice"].lower()
     cat_str = request.get_json()["cat"].lower()
@@ -446,16 +1149,12 @@ def best_books():
     field = "book_author"
     if cat_str == "genre":
         field = "book_genre"
-    books_by_choice = list(mongo.db.books.find({field: choice_str}))
+    books_by_choice = list(listing_db().books.find({field: choice_str}))
     if books_by_choice:
         for book in books_by_choice:
-            mean_rating = 0
-            if book['book_rating'] != []:
-                ratings = [rating[0] for rating in book['book_rating']]
-                mean_rating = round(mean(ratings), 1)
             book_list.append({
                 "book_title": book["book_title"].title(),
-                "book_rating": mean_rating,
+                "book_rating": round(book.get("rating_mean", 0), 1),
             })
         books_sorted = sorted(
             book_list, key=lambda x: x["book_rating"], reverse=True)
@@ -465,29 +1164,796 @@ def best_books():
         return "no book found", 500
 
 
+# groups the books by author or genre with their rating,
+# best rated book first
+def ratings_by(field):
+    groups = listing_db().books.aggregate([
+        {"$sort": {"rating_mean": -1}},
+        {"$group": {
+            "_id": "$" + field,
+            "books": {"$push": {
+                "book_title": "$book_title",
+                "rating_mean": {"$ifNull": ["$rating_mean", 0]}
+            }}
+        }}
+    ])
+    return {
+        group["_id"]: [
+            {
+                "book_title": book["book_title"].title(),
+                "book_rating": round(book["rating_mean"], 1)
+            }
+            for book in group["books"]
+        ]
+        for group in groups
+    }
+
+
+# JSON list of books, paginated like the main page
+@main.route('/api/books')
+@page_cache.cached("books", compress=True)
+def api_books():
+    books, next_after = books_page({})
+    return jsonify(
+        books=[
+            {
+                "_id": str(book["_id"]),
+                "book_title": book["book_title"],
+                "book_author": book["book_author"],
+                "book_short_description": book["book_short_description"],
+                "book_rating": round(book.get("rating_mean", 0), 1),
+                "book_votes": book.get("rating_count", 0),
+                "book_stars": book["star_rating"]
+            }
+            for book in books
+        ],
+        next_after=str(next_after) if next_after else None
+    )
+
+
+# checks that the worker can reach MongoDB through its connection pool,
+# answering 503 when no server answers within the selection timeout
+@main.route('/healthz')
+def healthz():
+    started = perf_counter()
+    try:
+        mongo.cx.admin.command('ping')
+    except PyMongoError as error:
+        return jsonify(status="unavailable", error=str(error)), 503
+    return jsonify(status="ok",
+                   mongo_ms=round((perf_counter() - started) * 1000, 1))
+
+
+# when MongoDB cannot be reached the request fails after the configured
+# timeouts, with a 503 asking the client to retry, instead of a 500
+@main.app_errorhandler(ConnectionFailure)
+def database_unavailable(error):
+    return ("The database is not available at the moment, "
+            "please try again in a few seconds.",
+            503, {"Retry-After": "5"})
+
+
+# request counts, latencies, Mongo commands and rendering times of every
+# endpoint of this worker, in the Prometheus text format
+@main.route('/metrics')
+def metrics():
+    return Response(request_metrics.prometheus()
+                    + rate_limiter.prometheus(),
+                    mimetype='text/plain; version=0.0.4')
+
+
+# JSON ratings of the books of every author, used by the stats charts
+@main.route('/api/stats/by-author')
+@page_cache.cached("stats", compress=True)
+def api_stats_by_author():
+    return jsonify(stats_groups("book_author"))
+
+
+# JSON ratings of the books of every genre, used by the stats charts
+@main.route('/api/stats/by-genre')
+@page_cache.cached("stats", compress=True)
+def api_stats_by_genre():
+    return jsonify(stats_groups("book_genre"))
+
+
+# identifies the top rated book of the last days from the daily rating
+# buckets, returned as [_id, title, average rating]
+def best_book_since(days):
+    start = rating_day(date.today() - timedelta(days=days))
+    top_books = list(listing_db().daily_ratings.aggregate([
+        {"$match": {"day": {"$gte": start}}},
+        {"$group": {
+            "_id": "$book_id",
+            "rating_sum": {"$sum": "$rating_sum"},
+            "rating_count": {"$sum": "$rating_count"}
+        }},
+        {"$project": {
+            "average": {"$divide": ["$rating_sum", "$rating_count"]}
+        }},
+        {"$sort": {"average": -1}},
+        # the buckets of a removed book are left out of the ranking
+        {"$lookup": {
+            "from": "books",
+            "localField": "_id",
+            "foreignField": "_id",
+            "as": "book"
+        }},
+        {"$unwind": "$book"},
+        {"$limit": 1},
+        {"$project": {"average": 1, "book_title": "$book.book_title"}}
+    ]))
+    if top_books == []:
+        return [None, "", 0]
+    top_book = top_books[0]
+    average = round(top_book["average"], 1)
+    # shows whole scores as 4/5 rather than 4.0/5
+    if average == int(average):
+        average = int(average)
+    return [top_book["_id"], top_book["book_title"], average]
+
+
 # identifies the top rated book of the current day
 def best_book_today():
-    today = date.today().strftime("%d-%b-%Y")
-    books = mongo.db.books.find()
-    books_rated_today = []
+    return best_book_since(0)
+
+
+# identifies the top rated book of the last 7 days
+def best_book_this_week():
+    return best_book_since(6)
+
+
+# Stores the ratings of the books of each author or genre in a document
+# of the stats_groups collection, and removes the groups that have no
+# book anymore
+def store_stats_groups(field, groups, computed_at):
+    if groups:
+        mongo.db.stats_groups.bulk_write([
+            ReplaceOne({"field": field, "name": name}, {
+                "field": field,
+                "name": name,
+                "books": books,
+                "computed_at": computed_at
+            }, upsert=True)
+            for name, books in groups.items()
+        ], ordered=False)
+    mongo.db.stats_groups.delete_many(
+        {"field": field, "computed_at": {"$lt": computed_at}})
+
+
+# Computes every figure of the stats page and stores them in a single
+# document of the stats_snapshot collection. The rankings by author and
+# genre, which list every book, are stored as one document per author or
+# genre in stats_groups, so that the snapshot stays small whatever the
+# size of the catalogue
+def refresh_stats_snapshot():
+    # the queries do not depend on each other, so they run at the same
+    # time and the refresh waits for the slowest one only
+    (top_ten, top_voted, top_rated_today, top_rated_week,
+     by_author, by_genre) = run_concurrently(
+        best_ten_books,
+        most_voted_book,
+        best_book_today,
+        best_book_this_week,
+        lambda: ratings_by("book_author"),
+        lambda: ratings_by("book_genre")
+    )
+    computed_at = datetime.utcnow()
+    store_stats_groups("book_author", by_author, computed_at)
+    store_stats_groups("book_genre", by_genre, computed_at)
+    snapshot = {
+        "_id": "stats",
+        "computed_at": computed_at,
+        "best_ten_books": top_ten,
+        "top_rated": top_ten[0] if top_ten else None,
+        "top_voted": top_voted,
+        "top_rated_today": top_rated_today,
+        "top_rated_week": top_rated_week
+    }
+    mongo.db.stats_snapshot.replace_one({"_id": "stats"}, snapshot,
+                                        upsert=True)
+    page_cache.invalidate("stats")
+    return snapshot
+
+
+# seconds since the snapshot was computed
+def snapshot_age(snapshot):
+    return (datetime.utcnow() - snapshot["computed_at"]).total_seconds()
+
+
+# fields of the stats snapshot shown by the stats page; a snapshot
+# written by an older version of the app also holds the rankings
+SNAPSHOT_PROJECTION = {
+    "computed_at": 1,
+    "best_ten_books": 1,
+    "top_rated": 1,
+    "top_voted": 1,
+    "top_rated_today": 1,
+    "top_rated_week": 1
+}
+
+
+# Returns the stats snapshot. A snapshot older than STATS_MAX_AGE is
+# recomputed before being shown, which only happens when no worker
+# has refreshed it in the background
+def stats_snapshot():
+    ensure_stats_refresher(current_app._get_current_object())
+    snapshot = mongo.db.stats_snapshot.find_one({"_id": "stats"},
+                                                SNAPSHOT_PROJECTION)
+    if (snapshot is None
+            or snapshot_age(snapshot) > current_app.config['STATS_MAX_AGE']):
+        snapshot = refresh_stats_snapshot()
+    return snapshot
+
+
+# ratings of the books of every author or genre (the field of the
+# books), by name, as computed with the stats snapshot
+def stats_groups(field):
+    stats_snapshot()
+    return {
+        group["name"]: group["books"]
+        for group in mongo.db.stats_groups.find(
+            {"field": field}, {"_id": 0, "name": 1, "books": 1})
+    }
+
+
+# background thread of this worker refreshing the stats snapshot
+stats_refresher = None
+stats_refresher_lock = threading.Lock()
+
+
+# starts the thread refreshing the stats snapshot, on the first request
+# served by the worker, so that it is never started before a fork
+def ensure_stats_refresher(app):
+    global stats_refresher
+    with stats_refresher_lock:
+        if stats_refresher is None or not stats_refresher.is_alive():
+            stats_refresher = threading.Thread(
+                target=refresh_stats_periodically, args=(app,), daemon=True)
+            stats_refresher.start()
+
+
+# Recomputes the stats snapshot once it is older than half of
+# STATS_MAX_AGE. Each worker checks it every quarter of STATS_MAX_AGE
+# and drops its cached stats pages when another worker has refreshed it,
+# so the figures shown are never older than STATS_MAX_AGE
+def refresh_stats_periodically(app):
+    max_age = app.config['STATS_MAX_AGE']
+    last_computed_at = None
+    with app.app_context():
+        while True:
+            sleep(max_age / 4)
+            try:
+                snapshot = mongo.db.stats_snapshot.find_one(
+                    {"_id": "stats"}, {"computed_at": 1})
+                if snapshot is None or snapshot_age(snapshot) > max_age / 2:
+                    snapshot = refresh_stats_snapshot()
+                elif snapshot["computed_at"] != last_computed_at:
+                    page_cache.invalidate("stats")
+                last_computed_at = snapshot["computed_at"]
+            except Exception:
+                app.logger.exception("The stats snapshot was not refreshed")
+
+
+# creates the indexes of the app
+@main.cli.command('init-indexes', help='Create the MongoDB indexes.')
+def init_indexes_command():
+    errors, warnings = init_indexes()
+    for warning in warnings:
+        click.echo(f"Unique index not created: {warning}", err=True)
+    for error in errors:
+        click.echo(f"Index not created: {error}", err=True)
+    if errors:
+        raise click.ClickException(f"{len(errors)} indexes not created")
+    if not warnings:
+        click.echo("Indexes are up to date")
+
+
+# stores the rating aggregates on books saved before they were
+# introduced, from the rating list they still hold. The votes cast since
+# the list stopped growing are only counted in the aggregates, so these
+# are only written while the list holds every vote of the book
+@main.cli.command('backfill-ratings',
+                 help='Store rating aggregates on existing books.')
+@click.option('--all', 'all_books', is_flag=True,
+              help='Recompute the aggregates of every book whose rating '
+                   'list holds all its votes.')
+def backfill_ratings(all_books):
+    books = mongo.db.books
+    query = {"book_rating": {"$exists": True}}
+    if not all_books:
+        query["rating_count"] = {"$exists": False}
+    updates = []
+    updated = 0
+    skipped = 0
+    for book in books.find(query, {"book_rating": 1}):
+        updates.append(UpdateOne(
+            {"_id": book["_id"],
+             "book_rating": book["book_rating"],
+             "rating_count": {"$in": [None, len(book["book_rating"])]}},
+            {"$set": dict(rating_aggregates(book["book_rating"]),
+                          updated_at=datetime.utcnow())}
+        ))
+        if len(updates) == 500:
+            result = books.bulk_write(updates, ordered=False)
+            updated += result.modified_count
+            skipped += len(updates) - result.matched_count
+            updates = []
+    if updates:
+        result = books.bulk_write(updates, ordered=False)
+        updated += result.modified_count
+        skipped += len(updates) - result.matched_count
+    click.echo(f"Rating aggregates stored on {updated} books")
+    if skipped:
+        click.echo(f"{skipped} books skipped, their aggregates count votes "
+                   "that are not in their rating list")
+
+
+# removes the rating list of the books still holding one, keeping their
+# votes in the star histogram and the daily rating buckets
+@main.cli.command('compact-ratings',
+                 help='Replace the rating list of books with the star '
+                      'histogram and the daily rating buckets.')
+def compact_ratings():
+    compacted = 0
+    changed = 0
+    size_before = 0
+    size_after = 0
+    for book in mongo.db.books.find({"book_rating": {"$exists": True}}):
+        if not compact_rating_list(book):
+            changed += 1
+            continue
+        compacted_book = dict(book)
+        del compacted_book["book_rating"]
+        if "rating_count" not in book:
+            compacted_book.update(rating_aggregates(book["book_rating"]))
+        size_before += len(BSON.encode(book))
+        size_after += len(BSON.encode(compacted_book))
+        compacted += 1
+    click.echo(f"Ratings compacted on {compacted} books")
+    if changed:
+        click.echo(f"{changed} books changed while being compacted, run the"
+                   " command again to compact them")
+    if compacted:
+        click.echo(f"Average book size: {size_before / compacted:.0f} bytes"
+                   f" before, {size_after / compacted:.0f} bytes after")
+
+
+# moves the comments embedded in books to the comments collection
+@main.cli.command('migrate-comments',
+                 help='Move the comments embedded in books to the comments '
+                      'collection.')
+def migrate_comments():
+    migrated_books = 0
+    migrated_comments = 0
+    books = mongo.db.books.find({"book_comments": {"$exists": True}},
+                                {"book_comments": 1})
     for book in books:
-        if book["book_rating"]:
-            _id = book["_id"]
-            title = book["book_title"]
-            today_ratings = [rating_list[0]
-                             for rating_list in book["book_rating"]
-                             if rating_list[1] == today]
-            today_average = 0
-            if today_ratings != []:
-                today_average = round(mean(today_ratings), 1)
-            books_rated_today.append([_id, title, today_average])
-    top_rated_today = max(books_rated_today, key=lambda x: x[2])
-    current_day = date.today().strftime("%d %B %Y")
-    return top_rated_today
+        comments = embedded_comment_documents(book, book["book_comments"])
+        if comments:
+            # removes the copies left by a migration of the book that
+            # was interrupted, recognised by their dates
+            mongo.db.comments.delete_many({
+                "book_id": book["_id"],
+                "created_at": {"$in": [comment["created_at"]
+                                       for comment in comments]}
+            })
+            mongo.db.comments.insert_many(comments)
+        # comments posted since the update of the app are already counted
+        mongo.db.books.update_one(
+            {"_id": book["_id"]},
+            {"$inc": {"comment_count": len(comments)},
+             "$unset": {"book_comments": ""}}
+        )
+        page_cache.invalidate(f"book:{book['_id']}")
+        migrated_books += 1
+        migrated_comments += len(comments)
+    click.echo(f"{migrated_comments} comments of {migrated_books} books "
+               "moved to the comments collection")
+
+
+# rebuilds the number of books of every author from the books collection
+@main.cli.command('reconcile-author-counts',
+                 help='Recount the books of every author.')
+def reconcile_author_counts():
+    counts = {
+        author["_id"]: author["book_count"]
+        for author in mongo.db.books.aggregate([
+            {"$group": {"_id": "$book_author", "book_count": {"$sum": 1}}}
+        ])
+    }
+    updates = [
+        UpdateOne({"author_name": author_name},
+                  {"$set": {"book_count": book_count}},
+                  upsert=True)
+        for author_name, book_count in counts.items()
+    ]
+    updates.append(UpdateMany(
+        {"author_name": {"$nin": list(counts)}},
+        {"$set": {"book_count": 0}}
+    ))
+    mongo.db.authors.bulk_write(updates, ordered=False)
+    click.echo(f"Book counts rebuilt for {len(counts)} authors")
+
+
+# Reads the records of a CSV file, or of a JSON lines file, one by one
+def read_records(file_path):
+    with open(file_path, newline='', encoding='utf-8') as records_file:
+        if file_path.endswith('.csv'):
+            yield from csv.DictReader(records_file)
+        else:
+            for line in records_file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+# Splits an iterable in lists of at most size items
+def batches(items, size):
+    items = iter(items)
+    while True:
+        batch = list(islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+# a list field of a record, stored as JSON in CSV files
+def record_list(record, field):
+    value = record.get(field) or []
+    if isinstance(value, str):
+        value = json.loads(value)
+    return value
+
+
+# Builds a book from an imported record, normalised like insert_book
+# does. Its ratings are read from a star histogram, as exported, or from
+# the list of [score, date] ratings of the exports of older versions
+def imported_book(record):
+    book = {
+        "book_title": record["book_title"].lower(),
+        "book_author": record["book_author"].lower(),
+        "book_genre": record.get("book_genre", "").lower(),
+        "book_description": record.get("book_description", ""),
+        "password": str(record.get("password", "")).lower(),
+        "comment_count": 0,
+        "updated_at": datetime.utcnow()
+    }
+    rating_histogram = record.get("rating_histogram") or {}
+    if isinstance(rating_histogram, str):
+        rating_histogram = json.loads(rating_histogram)
+    if rating_histogram:
+        book.update(histogram_aggregates(rating_histogram))
+    else:
+        book.update(rating_aggregates(record_list(record, "book_rating")))
+    return book
+
+
+# ids of the books with the given (title, author) keys found in the DB
+def book_ids_by_key(keys):
+    books = mongo.db.books.find(
+        {"book_title": {"$in": list({title for title, author in keys})}},
+        {"book_title": 1, "book_author": 1}
+    )
+    return {
+        (book["book_title"], book["book_author"]): book["_id"]
+        for book in books
+        if (book["book_title"], book["book_author"]) in keys
+    }
+
+
+# Inserts a batch of books, skipping the ones already in the DB or
+# repeated in the batch, and creates their missing authors and genres.
+# Returns the number of books inserted. Dated ratings and comments are
+# imported separately, with --kind ratings and --kind comments; the
+# rating lists and [text, author] comments embedded in older exports
+# are imported too
+def import_book_batch(records):
+    books = {}
+    embedded_comments = {}
+    rating_lists = {}
+    for record in records:
+        book = imported_book(record)
+        key = (book["book_title"], book["book_author"])
+        if key not in books:
+            books[key] = book
+            embedded_comments[key] = record_list(record, "book_comments")
+            rating_lists[key] = record_list(record, "book_rating")
+            book["comment_count"] = len(embedded_comments[key])
+    for key in book_ids_by_key(set(books)):
+        del books[key]
+    if not books:
+        return 0
+    try:
+        inserted = mongo.db.books.insert_many(
+            list(books.values()), ordered=False).inserted_ids
+    except BulkWriteError as error:
+        # books inserted by someone else since the check are skipped
+        # by the unique (title, author) index, other errors are raised
+        write_errors = error.details["writeErrors"]
+        if error.details.get("writeConcernErrors") or any(
+                failure["code"] != 11000 for failure in write_errors):
+            raise
+        failed = {failure["index"] for failure in write_errors}
+        inserted = [book["_id"] for index, book in enumerate(books.values())
+                    if index not in failed]
+    inserted = set(inserted)
+    new_books = [book for book in books.values() if book["_id"] in inserted]
+    author_counts = {}
+    for book in new_books:
+        author_counts[book["book_author"]] = (
+            author_counts.get(book["book_author"], 0) + 1)
+    mongo.db.authors.bulk_write([
+        UpdateOne({"author_name": author_name},
+                  {"$inc": {"book_count": count}},
+                  upsert=True)
+        for author_name, count in author_counts.items()
+    ], ordered=False)
+    import_names("genres", "genre_name",
+                 {book["book_genre"] for book in new_books})
+    comments = [
+        comment
+        for book in new_books
+        for comment in embedded_comment_documents(
+            book, embedded_comments[(book["book_title"],
+                                     book["book_author"])])
+    ]
+    if comments:
+        mongo.db.comments.insert_many(comments, ordered=False)
+    buckets = [
+        bucket
+        for book in new_books
+        for bucket in daily_rating_buckets(dict(
+            book, book_rating=rating_lists[(book["book_title"],
+                                            book["book_author"])]))
+    ]
+    if buckets:
+        mongo.db.daily_ratings.insert_many(buckets, ordered=False)
+    return len(new_books)
+
+
+# Turns the [text, author] comments once embedded in a book into
+# documents of the comments collection. Those comments have no date, so
+# they are dated from the creation of the book, a millisecond apart to
+# keep their order
+def embedded_comment_documents(book, book_comments):
+    created_at = book["_id"].generation_time.replace(tzinfo=None)
+    return [
+        {
+            "book_id": book["_id"],
+            "text": text,
+            "author": author,
+            "created_at": created_at + timedelta(milliseconds=index)
+        }
+        for index, (text, author) in enumerate(book_comments)
+    ]
+
+
+# Adds a batch of comments to books found by title and author, returns
+# the number of comments added
+def import_comment_batch(records):
+    keys = [(record["book_title"].lower(), record["book_author"].lower())
+            for record in records]
+    book_ids = book_ids_by_key(set(keys))
+    comments = []
+    comment_counts = {}
+    for key, record in zip(keys, records):
+        book_id = book_ids.get(key)
+        if book_id is None:
+            continue
+        created_at = record.get("created_at")
+        comments.append({
+            "book_id": book_id,
+            "text": record["text"],
+            "author": record["author"],
+            "created_at": (datetime.fromisoformat(created_at)
+                           if created_at else datetime.utcnow())
+        })
+        comment_counts[book_id] = comment_counts.get(book_id, 0) + 1
+    if comments:
+        mongo.db.comments.insert_many(comments, ordered=False)
+        mongo.db.books.bulk_write([
+            UpdateOne({"_id": book_id}, {"$inc": {"comment_count": count}})
+            for book_id, count in comment_counts.items()
+        ], ordered=False)
+    return len(comments)
+
+
+# Creates the authors or genres that are not in the DB yet, returns the
+# number created
+def import_names(collection, field, names):
+    names = {name.lower() for name in names if name}
+    if not names:
+        return 0
+    result = mongo.db[collection].bulk_write([
+        UpdateOne({field: name}, {"$setOnInsert": {field: name}},
+                  upsert=True)
+        for name in names
+    ], ordered=False)
+    return result.upserted_count
+
+
+# Adds a batch of dated ratings to books found by title and author,
+# returns the number of ratings added. Ratings that are not a score from
+# 1 to 5 are skipped
+def import_rating_batch(records):
+    ratings = []
+    for record in records:
+        try:
+            rating = int(record["rating"])
+        except (TypeError, ValueError):
+            continue
+        if rating not in RATING_SCORES:
+            continue
+        key = (record["book_title"].lower(), record["book_author"].lower())
+        rating_date = (record.get("date")
+                       or date.today().strftime("%d-%b-%Y"))
+        ratings.append((key, rating, rating_date))
+    book_ids = book_ids_by_key({key for key, rating, day in ratings})
+    book_updates = []
+    bucket_updates = []
+    for key, rating, rating_date in ratings:
+        book_id = book_ids.get(key)
+        if book_id is None:
+            continue
+        book_updates.append(UpdateOne({"_id": book_id},
+                                      rating_update(rating)))
+        day = datetime.strptime(rating_date, "%d-%b-%Y")
+        bucket_updates.append(UpdateOne(
+            {"book_id": book_id, "day": day},
+            {"$inc": {"rating_sum": rating, "rating_count": 1}},
+            upsert=True
+        ))
+    if book_updates:
+        mongo.db.books.bulk_write(book_updates, ordered=False)
+        mongo.db.daily_ratings.bulk_write(bucket_updates, ordered=False)
+    return len(book_updates)
+
+
+# imports records of books, authors, genres, ratings or comments from a
+# CSV or JSON lines file, in batches
+@main.cli.command('import-books',
+                 help='Import books, authors, genres, ratings or comments '
+                      'from a CSV or JSON lines file.')
+@click.argument('file_path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--kind', default='books', show_default=True,
+              type=click.Choice(['books', 'authors', 'genres', 'ratings',
+                                 'comments']))
+@click.option('--batch-size', default=1000, show_default=True)
+def import_books_command(file_path, kind, batch_size):
+    started = perf_counter()
+    read = 0
+    imported = 0
+    for batch in batches(read_records(file_path), batch_size):
+        read += len(batch)
+        if kind == 'books':
+            imported += import_book_batch(batch)
+        elif kind == 'ratings':
+            imported += import_rating_batch(batch)
+        elif kind == 'comments':
+            imported += import_comment_batch(batch)
+        else:
+            field = 'author_name' if kind == 'authors' else 'genre_name'
+            imported += import_names(kind, field,
+                                     [record[field] for record in batch])
+    page_cache.invalidate("books", "catalogue", "authors", "genres")
+    seconds = perf_counter() - started
+    click.echo(f"{imported} {kind} imported, {read - imported} skipped,"
+               f" from {read} records in {seconds:.1f} s"
+               f" ({read / max(seconds, 1e-6):.0f} records/s)")
+
+
+# fields written by export-books, by kind of record
+EXPORT_FIELDS = {
+    "books": ["book_title", "book_author", "book_genre",
+              "book_description", "password", "rating_histogram"],
+    "authors": ["author_name"],
+    "genres": ["genre_name"],
+    "comments": ["book_title", "book_author", "text", "author",
+                 "created_at"]
+}
+
+
+# Yields the records of a kind exported from the DB
+def export_records(kind, batch_size):
+    if kind == 'comments':
+        comments = mongo.db.comments.aggregate([
+            {"$sort": {"book_id": 1, "created_at": 1, "_id": 1}},
+            {"$lookup": {
+                "from": "books",
+                "localField": "book_id",
+                "foreignField": "_id",
+                "as": "book"
+            }},
+            {"$unwind": "$book"}
+        ], batchSize=batch_size)
+        for comment in comments:
+            yield {"book_title": comment["book"]["book_title"],
+                   "book_author": comment["book"]["book_author"],
+                   "text": comment["text"],
+                   "author": comment["author"],
+                   "created_at": comment["created_at"].isoformat()}
+        return
+    fields = EXPORT_FIELDS[kind]
+    documents = mongo.db[kind].find(
+        {}, dict.fromkeys(fields, 1)).batch_size(batch_size)
+    for document in documents:
+        yield {field: document.get(field, "") for field in fields}
+
+
+# exports books, authors, genres or comments to a CSV or JSON lines
+# file. The ratings of each book are exported as its star histogram
+@main.cli.command('export-books',
+                 help='Export books, authors, genres or comments to a CSV '
+                      'or JSON lines file.')
+@click.argument('file_path', type=click.Path(dir_okay=False, writable=True))
+@click.option('--kind', default='books', show_default=True,
+              type=click.Choice(['books', 'authors', 'genres', 'comments']))
+@click.option('--batch-size', default=1000, show_default=True)
+def export_books_command(file_path, kind, batch_size):
+    started = perf_counter()
+    exported = 0
+    with open(file_path, 'w', newline='', encoding='utf-8') as export_file:
+        if file_path.endswith('.csv'):
+            writer = csv.DictWriter(export_file, EXPORT_FIELDS[kind])
+            writer.writeheader()
+        for record in export_records(kind, batch_size):
+            if file_path.endswith('.csv'):
+                writer.writerow({
+                    field: json.dumps(value)
+                    if isinstance(value, (list, dict)) else value
+                    for field, value in record.items()
+                })
+            else:
+                export_file.write(json.dumps(record) + "\n")
+            exported += 1
+    seconds = perf_counter() - started
+    click.echo(f"{exported} {kind} exported in {seconds:.1f} s"
+               f" ({exported / max(seconds, 1e-6):.0f} records/s)")
+
+
+# bundles, minifies and fingerprints the static files, with their gzip
+# and brotli variants. Run when the app is built, the workers read the
+# manifest when they start. The build never downloads anything: the
+# vendor files are downloaded once with --vendor, checked and committed
+@main.cli.command('build-assets',
+                 help='Build the fingerprinted and compressed static files.')
+@click.option('--vendor', is_flag=True,
+              help='Download the vendor files missing from static/vendor '
+                   'first, to be checked and committed.')
+def build_assets_command(vendor):
+    static_folder = current_app.static_folder
+    if vendor:
+        for name, digest in vendor_assets(static_folder).items():
+            click.echo(f"Downloaded {name} (sha256 {digest})")
+    for name in missing_vendor_assets(static_folder):
+        click.echo(f"Warning: {name} is missing, the pages load it from "
+                   f"{VENDOR[name]}. Download it with --vendor, check it "
+                   "and commit it.", err=True)
+    try:
+        sizes = build_assets(static_folder,
+                             current_app.config['ASSETS_FOLDER'])
+    except FileNotFoundError as error:
+        raise click.ClickException(str(error))
+    for name, variants in sizes.items():
+        click.echo(f"{name:<20} " + "  ".join(
+            f"{variant} {size / 1024:7.1f} KiB"
+            for variant, size in variants.items()))
+
+
+# writes the resized variants of the images served by the pages (WebP
+# and JPEG, and AVIF when Pillow can write it) and prints their size
+@main.cli.command('build-images',
+                 help='Build the resized variants of the static images.')
+def build_images_command():
+    report = build_images(current_app.static_folder,
+                          current_app.config['ASSETS_FOLDER'])
+    for name, sizes in report.items():
+        click.echo(f"{name}: {sizes['original'] / 1024:.1f} KiB")
+        for variant, size in sizes["variants"].items():
+            click.echo(f"  {variant:<12} {size / 1024:8.1f} KiB"
+                       f"  {size / sizes['original']:6.1%}")
 
 
 if __name__ == '__main__':
-    app.run(host=os.environ.get('IP'),
-            port=int(os.environ.get('PORT')),
-            debug=os.getenv("DEBUG", False)
-            )
+    create_app().run(host=os.environ.get('IP'),
+                     port=int(os.environ.get('PORT')),
+                     debug=os.getenv("DEBUG", False))
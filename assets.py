@@ -0,0 +1,374 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import re
+from urllib.request import urlopen
+from flask import Markup, abort, request, send_from_directory, url_for
+
+
+# third party files served from static/vendor once downloaded by
+# `flask build-assets --vendor` and committed, with the CDN they are
+# loaded from until then
+VENDOR = {
+    "vendor/bootstrap.min.css": "https://maxcdn.bootstrapcdn.com/bootstrap/"
+                                "4.0.0/css/bootstrap.min.css",
+    "vendor/popper.min.js": "https://cdnjs.cloudflare.com/ajax/libs/"
+                            "popper.js/1.12.9/umd/popper.min.js",
+    "vendor/bootstrap.min.js": "https://maxcdn.bootstrapcdn.com/bootstrap/"
+                               "4.0.0/js/bootstrap.min.js",
+    "vendor/dc.min.css": "https://cdnjs.cloudflare.com/ajax/libs/"
+                         "dc/2.1.8/dc.min.css",
+    "vendor/d3.min.js": "https://cdnjs.cloudflare.com/ajax/libs/"
+                        "d3/3.5.17/d3.min.js",
+    "vendor/crossfilter.min.js": "https://cdnjs.cloudflare.com/ajax/libs/"
+                                 "crossfilter/1.3.12/crossfilter.min.js",
+    "vendor/dc.min.js": "https://cdnjs.cloudflare.com/ajax/libs/"
+                        "dc/2.1.8/dc.min.js"
+}
+
+# files of each bundle, relative to the static folder, in load order
+BUNDLES = {
+    "base.css": [
+        "vendor/bootstrap.min.css",
+        "fontawesome-free/css/all.min.css",
+        "css/clean-blog.css",
+        "css/booksters.css"
+    ],
+    "base.js": [
+        "jquery/jquery.min.js",
+        "vendor/popper.min.js",
+        "vendor/bootstrap.min.js",
+        "js/clean-blog.min.js"
+    ],
+    "stats.css": ["vendor/dc.min.css"],
+    "stats.js": [
+        "vendor/d3.min.js",
+        "vendor/crossfilter.min.js",
+        "vendor/dc.min.js"
+    ]
+}
+
+# other static files given a fingerprinted copy
+FILES = ["img/home-bg.jpg"]
+
+# files worth serving compressed
+COMPRESSED_EXTENSIONS = (".css", ".js", ".svg")
+
+CSS_URL = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+
+
+# Downloads the vendor files missing from the static folder, returns the
+# names of the files downloaded with the sha256 of their content, to be
+# checked against the published hashes before the files are committed
+def vendor_assets(static_folder, vendor=VENDOR):
+    downloaded = {}
+    for name, url in vendor.items():
+        path = os.path.join(static_folder, name)
+        if os.path.exists(path):
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with urlopen(url, timeout=30) as response:
+            content = response.read()
+        with open(path, 'wb') as output:
+            output.write(content)
+        downloaded[name] = hashlib.sha256(content).hexdigest()
+    return downloaded
+
+
+# Names of the vendor files missing from the static folder
+def missing_vendor_assets(static_folder, vendor=VENDOR):
+    return [name for name in vendor
+            if not os.path.exists(os.path.join(static_folder, name))]
+
+
+# Makes the relative urls of a stylesheet point to the same files once
+# the stylesheet is moved from its folder to the output folder
+def rewrite_css_urls(css, source, output):
+    def rewrite(match):
+        url = match.group(2)
+        if re.match(r"^(data:|[a-z]+://|/|#)", url):
+            return match.group(0)
+        path, separator, suffix = re.match(
+            r"([^?#]*)([?#]?)(.*)", url).groups()
+        path = posixpath.normpath(
+            posixpath.join(posixpath.dirname(source), path))
+        url = posixpath.relpath(path, output) + separator + suffix
+        return f"url({match.group(1)}{url}{match.group(1)})"
+    return CSS_URL.sub(rewrite, css)
+
+
+# Removes the comments (except the /*! license comments) and the
+# whitespace of a stylesheet, when rcssmin is not installed
+def minify_css(css):
+    css = re.sub(r"/\*(?!!).*?\*/", "", css, flags=re.S)
+    css = re.sub(r"\s+", " ", css)
+    css = re.sub(r"\s*([{};:,>])\s*", r"\1", css)
+    return css.replace(";}", "}").strip()
+
+
+# Minifies a source that is not minified already. Scripts are only
+# minified when rjsmin is installed
+def minify(source, text):
+    if re.search(r"\.min\.(css|js)$", source):
+        return text
+    if source.endswith(".css"):
+        try:
+            import rcssmin
+        except ImportError:
+            return minify_css(text)
+        return rcssmin.cssmin(text, keep_bang_comments=True)
+    try:
+        import rjsmin
+    except ImportError:
+        return text
+    return rjsmin.jsmin(text, keep_bang_comments=True)
+
+
+# Writes a file with its gzip and, when the brotli module is installed,
+# its brotli variants. Returns the size of each variant
+def write_variants(path, content):
+    with open(path, 'wb') as output:
+        output.write(content)
+    sizes = {"raw": len(content)}
+    if not path.endswith(COMPRESSED_EXTENSIONS):
+        return sizes
+    # a fixed mtime keeps the output identical between builds
+    compressed = gzip.compress(content, compresslevel=9, mtime=0)
+    with open(path + '.gz', 'wb') as output:
+        output.write(compressed)
+    sizes["gzip"] = len(compressed)
+    try:
+        import brotli
+    except ImportError:
+        return sizes
+    compressed = brotli.compress(content)
+    with open(path + '.br', 'wb') as output:
+        output.write(compressed)
+    sizes["brotli"] = len(compressed)
+    return sizes
+
+
+# Name of a file with a hash of its content, e.g. base.3f2a9c1b04.css
+def fingerprinted(name, content):
+    stem, extension = posixpath.splitext(posixpath.basename(name))
+    digest = hashlib.sha256(content).hexdigest()[:10]
+    return f"{stem}.{digest}{extension}"
+
+
+# Splits the sources of a bundle in the parts the pages load, in order:
+# the runs of sources found in the static folder, each bundled into one
+# file, and the CDN url of each vendor file missing
+def bundle_parts(sources, missing):
+    parts = []
+    for source in sources:
+        if source in missing:
+            parts.append(VENDOR[source])
+        elif parts and isinstance(parts[-1], list):
+            parts[-1].append(source)
+        else:
+            parts.append([source])
+    return parts
+
+
+# Minifies and concatenates the sources of a bundle into a fingerprinted
+# file of the output folder. Returns its path in the static folder and
+# the sizes of its variants
+def build_bundle(static_folder, output, name, sources):
+    parts = []
+    for source in sources:
+        path = os.path.join(static_folder, source)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"{source} is missing")
+        with open(path, encoding='utf-8') as source_file:
+            text = minify(source, source_file.read())
+        if source.endswith(".css"):
+            text = rewrite_css_urls(text, source, output)
+        parts.append(text)
+    # scripts are separated so that a file without a final semicolon
+    # does not run into the next one
+    separator = ";\n" if name.endswith(".js") else "\n"
+    content = separator.join(parts).encode('utf-8')
+    path = f"{output}/{fingerprinted(name, content)}"
+    return path, write_variants(os.path.join(static_folder, path), content)
+
+
+# Builds the bundles and fingerprinted files in the output folder (a
+# folder of the static folder), writes their manifest and removes the
+# files of previous builds. A bundle using vendor files that are not
+# downloaded is built in parts around them (base-1.css, base-2.css...),
+# listed in the manifest in load order with the CDN url of the missing
+# files. Returns the sizes of every output file
+def build_assets(static_folder, output="dist", bundles=BUNDLES, files=FILES):
+    output_folder = os.path.join(static_folder, output)
+    os.makedirs(output_folder, exist_ok=True)
+    missing = missing_vendor_assets(static_folder)
+    manifest = {}
+    sizes = {}
+    for name, sources in bundles.items():
+        parts = bundle_parts(sources, missing)
+        if parts == [sources]:
+            manifest[name], sizes[name] = build_bundle(
+                static_folder, output, name, sources)
+            continue
+        stem, extension = posixpath.splitext(name)
+        manifest[name] = []
+        for number, part in enumerate(parts, 1):
+            if isinstance(part, str):
+                manifest[name].append(part)
+                continue
+            part_name = f"{stem}-{number}{extension}"
+            path, sizes[part_name] = build_bundle(
+                static_folder, output, part_name, part)
+            manifest[name].append(path)
+    for name in files:
+        with open(os.path.join(static_folder, name), 'rb') as source_file:
+            content = source_file.read()
+        manifest[name] = f"{output}/{fingerprinted(name, content)}"
+        sizes[name] = write_variants(
+            os.path.join(static_folder, manifest[name]), content)
+    # the images built by build_images are kept
+    current = set()
+    for paths in manifest.values():
+        current.update(posixpath.basename(path)
+                       for path in ([paths] if isinstance(paths, str)
+                                    else paths))
+    current.update(("manifest.json", "images.json"))
+    for file_name in os.listdir(output_folder):
+        path = os.path.join(output_folder, file_name)
+        if re.sub(r"\.(gz|br)$", "", file_name) not in current and \
+                os.path.isfile(path):
+            os.remove(path)
+    with open(os.path.join(output_folder, "manifest.json"), 'w') as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    return sizes
+
+
+# Reads a manifest of the built files, empty when they are not built
+def read_manifest(path):
+    try:
+        with open(path) as manifest:
+            return json.load(manifest)
+    except FileNotFoundError:
+        return {}
+
+
+# Serves the files built by build_assets and build_images.
+# url_for('static', ...) gives the fingerprinted copy of a file listed in
+# the manifest, which is served with a far future Cache-Control and, when
+# the browser accepts it, precompressed. A bundle built in parts links
+# each of them, and the vendor files missing from their CDN. Without a
+# manifest (the assets are not built) the original files are linked and
+# the vendor files missing are loaded from their CDN.
+class Assets:
+
+    def __init__(self, app=None):
+        self.manifest = {}
+        self.images = {}
+        self.folder = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('ASSETS_FOLDER', 'dist')
+        app.config.setdefault('ASSETS_MAX_AGE', 365 * 24 * 3600)
+        self.max_age = app.config['ASSETS_MAX_AGE']
+        self.load(os.path.join(app.static_folder,
+                               app.config['ASSETS_FOLDER']))
+        app.url_defaults(self.fingerprint)
+        app.add_url_rule(
+            f"{app.static_url_path}/{app.config['ASSETS_FOLDER']}"
+            "/<path:filename>",
+            endpoint="assets", view_func=self.send)
+        app.add_template_global(self.tags, "asset_tags")
+        app.add_template_global(self.picture, "picture")
+
+    # reads the manifests of the assets built in the folder, if any
+    def load(self, folder):
+        self.folder = folder
+        self.manifest = read_manifest(os.path.join(folder, "manifest.json"))
+        self.images = read_manifest(os.path.join(folder, "images.json"))
+
+    def fingerprint(self, endpoint, values):
+        if endpoint == "static" and isinstance(
+                self.manifest.get(values.get("filename")), str):
+            values["filename"] = self.manifest[values["filename"]]
+
+    def send(self, filename):
+        path = os.path.join(self.folder, filename)
+        if filename.endswith(('.gz', '.br')) or not os.path.isfile(path):
+            abort(404)
+        encodings = request.accept_encodings
+        for encoding, extension in (("br", ".br"), ("gzip", ".gz")):
+            if encodings[encoding] and os.path.isfile(path + extension):
+                response = send_from_directory(
+                    self.folder, filename + extension,
+                    mimetype=mimetypes.guess_type(filename)[0])
+                response.headers["Content-Encoding"] = encoding
+                break
+        else:
+            response = send_from_directory(self.folder, filename)
+        response.vary.add("Accept-Encoding")
+        # the name of the file changes with its content
+        response.headers["Cache-Control"] = (
+            f"public, max-age={self.max_age}, immutable")
+        return response
+
+    # link or script tags loading a bundle
+    def tags(self, name):
+        built = self.manifest.get(name)
+        if isinstance(built, str):
+            urls = [url_for("static", filename=name)]
+        elif built is not None:
+            urls = [part if "://" in part
+                    else url_for("static", filename=part)
+                    for part in built]
+        else:
+            static_folder = os.path.dirname(self.folder)
+            urls = [
+                VENDOR[source]
+                if source in VENDOR and not os.path.exists(
+                    os.path.join(static_folder, source))
+                else url_for("static", filename=source)
+                for source in BUNDLES[name]
+            ]
+        if name.endswith(".css"):
+            template = '<link href="{}" rel="stylesheet" type="text/css">'
+        else:
+            template = '<script src="{}"></script>'
+        return Markup("\n".join(
+            template.format(Markup.escape(url)) for url in urls))
+
+    # <picture> element of an image offering its resized variants in each
+    # format, from the preferred one, so the browser downloads the
+    # smallest file fitting the width the image takes on the page
+    # (sizes). A plain <img> when the images are not built
+    def picture(self, name, alt="", sizes="100vw", **attributes):
+        attributes = "".join(f' {key}="{Markup.escape(value)}"'
+                             for key, value in attributes.items())
+        image = self.images.get(name)
+        if image is None:
+            return Markup(
+                f'<img src="{url_for("static", filename=name)}"'
+                f' alt="{Markup.escape(alt)}"{attributes}>')
+
+        def srcset(variants):
+            return ", ".join(f"{url_for('static', filename=path)} {width}w"
+                             for width, path in variants)
+        variants = dict(image["variants"])
+        # JPEG is understood by every browser
+        fallback = variants.pop("jpeg")
+        lines = ["<picture>"]
+        for image_format, format_variants in variants.items():
+            lines.append(f'<source type="image/{image_format}"'
+                         f' srcset="{srcset(format_variants)}"'
+                         f' sizes="{Markup.escape(sizes)}">')
+        lines.append(
+            f'<img src="{url_for("static", filename=fallback[-1][1])}"'
+            f' srcset="{srcset(fallback)}" sizes="{Markup.escape(sizes)}"'
+            f' width="{image["width"]}" height="{image["height"]}"'
+            f' alt="{Markup.escape(alt)}"{attributes}>')
+        lines.append("</picture>")
+        return Markup("\n".join(lines))
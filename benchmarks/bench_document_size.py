@@ -0,0 +1,36 @@
+"""Compares the size of books storing every vote in a rating list with
+the size of books storing a star histogram, the format written by
+flask compact-ratings.
+
+    python -m benchmarks.bench_document_size
+"""
+import random
+from bson import BSON
+from app import rating_aggregates
+from benchmarks.catalogue import random_word, synthetic_books
+
+
+def main():
+    rng = random.Random(29)
+    authors = [random_word(rng) for _ in range(100)]
+    genres = [random_word(rng) for _ in range(20)]
+    print(f"{'votes per book':>14}  {'rating list':>12}  {'histogram':>10}")
+    for votes in (0, 10, 100, 1000, 10000):
+        size_before = 0
+        size_after = 0
+        books = list(synthetic_books(rng, 100, authors, genres,
+                                     ratings_per_book=0))
+        for book in books:
+            # every book gets exactly the given number of votes
+            book["book_rating"] = [[rng.randint(1, 5), "10-Apr-2020"]
+                                   for _ in range(votes)]
+            book.update(rating_aggregates(book["book_rating"]))
+            size_before += len(BSON.encode(book))
+            del book["book_rating"]
+            size_after += len(BSON.encode(book))
+        print(f"{votes:>14}  {size_before / len(books):>10.0f} B"
+              f"  {size_after / len(books):>8.0f} B")
+
+
+if __name__ == '__main__':
+    main()
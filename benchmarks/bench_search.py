@@ -0,0 +1,80 @@
+"""Times the in-memory search index on a synthetic catalogue.
+
+Usage: python -m benchmarks.bench_search [--books 100000] [--queries 1000]
+"""
+import argparse
+import random
+import statistics
+import string
+import time
+from bson.objectid import ObjectId
+from benchmarks.catalogue import random_word
+from search import SearchIndex
+
+
+# Generates books with titles and authors drawn from a fixed vocabulary
+def synthetic_books(count, seed=29):
+    rng = random.Random(seed)
+    vocabulary = [random_word(rng) for _ in range(20000)]
+    authors = [f"{random_word(rng)} {random_word(rng)}"
+               for _ in range(max(count // 10, 1))]
+    for _ in range(count):
+        yield {
+            "_id": ObjectId(),
+            "book_title": ' '.join(rng.choice(vocabulary)
+                                   for _ in range(rng.randint(1, 5))),
+            "book_author": rng.choice(authors)
+        }
+
+
+# Introduces a typo in a word
+def misspell(rng, word):
+    position = rng.randrange(len(word))
+    return word[:position] + rng.choice(string.ascii_lowercase) + \
+        word[position + 1:]
+
+
+# Times a function over the queries, in milliseconds
+def time_queries(function, queries):
+    timings = []
+    for query in queries:
+        start = time.perf_counter()
+        function(query)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def report(name, timings):
+    percentiles = statistics.quantiles(timings, n=100)
+    print(f"{name:<14} p50 {percentiles[49]:7.3f} ms"
+          f"  p95 {percentiles[94]:7.3f} ms"
+          f"  p99 {percentiles[98]:7.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--books', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=1000)
+    args = parser.parse_args()
+    rng = random.Random(1)
+    books = list(synthetic_books(args.books))
+    index = SearchIndex()
+    start = time.perf_counter()
+    index.load(books)
+    print(f"Index of {args.books} books built in "
+          f"{time.perf_counter() - start:.2f} s")
+    samples = [rng.choice(books) for _ in range(args.queries)]
+    titles = [book["book_title"].split() for book in samples]
+    report("prefix", time_queries(
+        index.complete, [words[0][:3] for words in titles]))
+    report("two prefixes", time_queries(
+        index.complete,
+        [f"{words[0]} {book['book_author'][:2]}"
+         for words, book in zip(titles, samples)]))
+    report("typo", time_queries(
+        index.fuzzy_search,
+        [misspell(rng, words[0]) for words in titles]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""Measures the cold start of a worker: the time a new Python process
+takes to import app.py, measured with python -X importtime, and to
+create the app with create_app(). No MongoDB server is needed, since
+the Mongo client only connects on its first query.
+
+    python -m benchmarks.bench_startup --repeat 10 --budget-ms 250
+
+Exits with status 1 when the median import time is over the budget.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+CREATE_APP = (
+    "import time\n"
+    "started = time.perf_counter()\n"
+    "from app import create_app\n"
+    "create_app()\n"
+    "print((time.perf_counter() - started) * 1000)\n"
+)
+
+
+def environment():
+    return dict(os.environ,
+                MONGO_URI=os.environ.get(
+                    'MONGO_URI', 'mongodb://localhost/booksters_bench'))
+
+
+# Imports the module in a new process and returns the cumulative import
+# time of every module imported at the top level, in milliseconds
+def import_times(module='app'):
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True, text=True, env=environment(), check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        # a module is listed after the modules it imports, which are
+        # indented by 2 more spaces
+        if not name.startswith('  '):
+            if name.strip() == module:
+                times[module] = int(cumulative) / 1000
+                return times
+            times = {}
+        elif not name.startswith('    '):
+            times[name.strip()] = int(cumulative) / 1000
+    return times
+
+
+# Creates the app in a new process, returns the time taken in milliseconds
+def create_app_time():
+    result = subprocess.run(
+        [sys.executable, '-c', CREATE_APP],
+        capture_output=True, text=True, env=environment(), check=True)
+    return float(result.stdout.strip())
+
+
+# Medians of the import and create_app() times over several processes,
+# and the slowest modules imported by app.py
+def startup_times(repeat=10):
+    runs = [import_times() for _ in range(repeat)]
+    create_app_times = [create_app_time() for _ in range(repeat)]
+    modules = {
+        name: statistics.median(run.get(name, 0) for run in runs)
+        for name in runs[0] if name != 'app'
+    }
+    return {
+        "import_app_ms": round(
+            statistics.median(run['app'] for run in runs), 1),
+        "create_app_ms": round(statistics.median(create_app_times), 1),
+        "slowest_imports_ms": {
+            name: round(time_ms, 1) for name, time_ms in
+            sorted(modules.items(), key=lambda item: -item[1])[:10]
+        }
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--budget-ms', type=float, default=250,
+                        help='maximum median import time of app.py')
+    args = parser.parse_args()
+    times = startup_times(args.repeat)
+    print(f"import app     {times['import_app_ms']:8.1f} ms"
+          f"  (budget {args.budget_ms:.0f} ms)")
+    print(f"create_app()   {times['create_app_ms']:8.1f} ms"
+          " (import included)")
+    print("slowest imports of app.py:")
+    for name, time_ms in times["slowest_imports_ms"].items():
+        print(f"  {name:<24} {time_ms:8.1f} ms")
+    if times['import_app_ms'] > args.budget_ms:
+        print("Import time over budget")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""Synthetic catalogue of books, authors, genres, ratings and comments."""
+import random
+from datetime import date, timedelta
+from bson.objectid import ObjectId
+from app import (
+    daily_rating_buckets,
+    embedded_comment_documents,
+    rating_aggregates
+)
+
+
+# Returns a random pronounceable word
+def random_word(rng, min_length=3, max_length=10):
+    consonants = "bcdfghlmnprstvz"
+    vowels = "aeiou"
+    length = rng.randint(min_length, max_length)
+    return ''.join(rng.choice(consonants if i % 2 == 0 else vowels)
+                   for i in range(length))
+
+
+# Returns a random sentence of words
+def random_sentence(rng, vocabulary, min_words=4, max_words=15):
+    words = [rng.choice(vocabulary)
+             for _ in range(rng.randint(min_words, max_words))]
+    return ' '.join(words).capitalize() + '.'
+
+
+# Generates books with comments and with dated ratings spread over the
+# last days. The ratings and comments are kept in the lists books held
+# before compact-ratings and migrate-comments; seed_catalogue moves them
+# to their collections
+def synthetic_books(rng, count, authors, genres, ratings_per_book=10,
+                    comments_per_book=2, days=30):
+    vocabulary = [random_word(rng) for _ in range(5000)]
+    today = date.today()
+    for _ in range(count):
+        book_rating = [
+            [rng.randint(1, 5),
+             (today - timedelta(days=rng.randrange(days)))
+             .strftime("%d-%b-%Y")]
+            for _ in range(rng.randint(0, 2 * ratings_per_book))
+        ]
+        book = {
+            "_id": ObjectId(),
+            "book_title": ' '.join(rng.choice(vocabulary)
+                                   for _ in range(rng.randint(1, 5))),
+            "book_author": rng.choice(authors),
+            "book_genre": rng.choice(genres),
+            "book_description": ' '.join(
+                random_sentence(rng, vocabulary) for _ in range(5)),
+            "password": "12",
+            "book_rating": book_rating,
+            "book_comments": [
+                [random_sentence(rng, vocabulary), rng.choice(authors)]
+                for _ in range(rng.randint(0, 2 * comments_per_book))
+            ]
+        }
+        book.update(rating_aggregates(book_rating))
+        yield book
+
+
+# Inserts books with their rating buckets and comments
+def insert_batch(db, books, buckets, comments):
+    if books:
+        db.books.insert_many(books, ordered=False)
+    if buckets:
+        db.daily_ratings.insert_many(buckets, ordered=False)
+    if comments:
+        db.comments.insert_many(comments, ordered=False)
+
+
+# Replaces the content of the database with a synthetic catalogue,
+# returns the names of the authors and genres created
+def seed_catalogue(db, books=1000, authors=100, genres=20,
+                   ratings_per_book=10, comments_per_book=2, seed=29,
+                   batch_size=1000):
+    rng = random.Random(seed)
+    for collection in ("books", "authors", "genres", "daily_ratings",
+                       "comments", "stats_snapshot", "stats_groups"):
+        db[collection].drop()
+    author_names = sorted({f"{random_word(rng)} {random_word(rng)}"
+                           for _ in range(authors)})
+    genre_names = sorted({random_word(rng) for _ in range(genres)})
+    db.genres.insert_many([{"genre_name": name} for name in genre_names])
+    book_counts = dict.fromkeys(author_names, 0)
+    batch = []
+    buckets = []
+    comments = []
+    for book in synthetic_books(rng, books, author_names, genre_names,
+                                ratings_per_book, comments_per_book):
+        book_counts[book["book_author"]] += 1
+        batch.append(book)
+        buckets.extend(daily_rating_buckets(book))
+        del book["book_rating"]
+        book_comments = embedded_comment_documents(
+            book, book.pop("book_comments"))
+        book["comment_count"] = len(book_comments)
+        comments.extend(book_comments)
+        if len(batch) == batch_size:
+            insert_batch(db, batch, buckets, comments)
+            batch = []
+            buckets = []
+            comments = []
+    insert_batch(db, batch, buckets, comments)
+    db.authors.insert_many([
+        {"author_name": name, "book_count": count}
+        for name, count in book_counts.items()
+    ])
+    return author_names, genre_names
@@ -0,0 +1,143 @@
+"""Measures requests per second and latency of pages under concurrent load.
+
+Against a running server:
+    python -m benchmarks.loadtest --url http://localhost:8000 --paths / /stats
+
+Starting the Flask development server and gunicorn one after the other
+and comparing them (needs MONGO_URI and SECRET_KEY in the environment):
+    python -m benchmarks.loadtest --compare --paths / /stats
+
+Starting gunicorn with the threaded workers and then with the gevent
+workers, with the same number of processes, and comparing them:
+    python -m benchmarks.loadtest --compare-workers --concurrency 64
+"""
+import argparse
+import http.client
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from urllib.parse import urlsplit
+
+
+# Sends requests to a path from several threads, each one keeping its
+# connection alive, for the given number of seconds
+def load(url, path, concurrency, duration):
+    parts = urlsplit(url)
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker():
+        connection = http.client.HTTPConnection(parts.hostname, parts.port)
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                connection.request('GET', path)
+                response = connection.getresponse()
+                response.read()
+                failed = response.status >= 500
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                connection = http.client.HTTPConnection(
+                    parts.hostname, parts.port)
+                failed = True
+            elapsed = time.perf_counter() - start
+            with lock:
+                if failed:
+                    errors.append(elapsed)
+                else:
+                    latencies.append(elapsed)
+        connection.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors
+
+
+def report(name, path, latencies, errors, duration):
+    if len(latencies) < 2:
+        print(f"{name:<10} {path:<12} no successful requests "
+              f"({len(errors)} errors)")
+        return
+    percentiles = statistics.quantiles(latencies, n=100)
+    print(f"{name:<10} {path:<12} {len(latencies) / duration:8.1f} req/s"
+          f"  p50 {percentiles[49] * 1000:7.1f} ms"
+          f"  p99 {percentiles[98] * 1000:7.1f} ms"
+          f"  errors {len(errors)}")
+
+
+# Waits until the server answers on its home page
+def wait_for(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=1).read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not start within {timeout} seconds")
+
+
+# Starts a server with the command, runs the load test on each path,
+# then stops the server
+def run_server(name, command, port, args, **variables):
+    environment = dict(os.environ, IP='127.0.0.1', PORT=str(port),
+                       **variables)
+    server = subprocess.Popen(command, env=environment,
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    try:
+        wait_for(url + '/')
+        for path in args.paths:
+            latencies, errors = load(url, path, args.concurrency,
+                                     args.duration)
+            report(name, path, latencies, errors, args.duration)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:8000')
+    parser.add_argument('--paths', nargs='+', default=['/', '/stats'])
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--compare', action='store_true',
+                        help='start and compare the dev server and gunicorn')
+    parser.add_argument('--compare-workers', action='store_true',
+                        help='start and compare gunicorn with the gthread '
+                             'and the gevent workers')
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+    if args.compare:
+        run_server('dev', [sys.executable, 'app.py'], args.port, args)
+        run_server('gunicorn',
+                   ['gunicorn', '-c', 'gunicorn.conf.py', 'wsgi:app'],
+                   args.port + 1, args)
+    elif args.compare_workers:
+        gunicorn = ['gunicorn', '-c', 'gunicorn.conf.py', 'wsgi:app']
+        run_server('gthread', gunicorn, args.port, args,
+                   GUNICORN_WORKER_CLASS='gthread')
+        run_server('gevent', gunicorn, args.port + 1, args,
+                   GUNICORN_WORKER_CLASS='gevent')
+    else:
+        for path in args.paths:
+            latencies, errors = load(args.url, path, args.concurrency,
+                                     args.duration)
+            report('server', path, latencies, errors, args.duration)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+"""Seeds a benchmark database with a synthetic catalogue and times the
+routes of the app through its test client.
+
+    python -m benchmarks.run --mongo-uri mongodb://localhost/booksters_bench \
+        --books 10000 --output bench.json --baseline previous.json
+
+The collections of the benchmark database are dropped before seeding,
+so never point --mongo-uri to a database holding real data. With
+--mongomock the catalogue is kept in memory (routes relying on
+operators mongomock does not implement, such as $text, are skipped).
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime
+from app import (
+    best_book_today,
+    best_ten_books,
+    create_app,
+    init_indexes,
+    mongo
+)
+from benchmarks.bench_startup import startup_times
+from benchmarks.catalogue import seed_catalogue
+
+
+# Times a request function, returning the latencies in milliseconds and
+# the peak of memory allocated by a single call, in KiB. Memory is traced
+# on a separate call so that tracing does not slow down the timed ones
+def measure(function, repeat):
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        latencies.append((time.perf_counter() - start) * 1000)
+    percentiles = statistics.quantiles(latencies, n=100)
+    return {
+        "p50_ms": round(percentiles[49], 3),
+        "p95_ms": round(percentiles[94], 3),
+        "p99_ms": round(percentiles[98], 3),
+        "mean_ms": round(statistics.mean(latencies), 3),
+        "peak_memory_kib": round(peak / 1024, 1)
+    }
+
+
+# Requests a page, reads it and checks the answer is not an error. A
+# streamed page is only rendered while its body is read, which also
+# ends its request context
+def get(client, url):
+    def request():
+        response = client.get(url)
+        response.get_data()
+        response.close()
+        assert response.status_code < 400, (url, response.status_code)
+    return request
+
+
+# Scenarios timed by the benchmark, by name
+def scenarios(client, authors, genres, book_id, search_word):
+    return {
+        "get_books": get(client, "/"),
+        "get_book": get(client, f"/book/{book_id}"),
+        "get_books_by_author": get(
+            client, f"/get_books_author/{authors[0]}"),
+        "get_books_by_genre": get(
+            client, f"/get_books_genre/{genres[0]}"),
+        "stats": get(client, "/stats"),
+        "api_stats_by_author": get(client, "/api/stats/by-author"),
+        "best_ten_books": best_ten_books,
+        "best_book_today": best_book_today,
+        "best_books": lambda: client.post(
+            "/best_books/", json={"choice": genres[0], "cat": "genre"}),
+        "search_book": get(client, f"/search?q={search_word}")
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Prints the change of each latency against a previous run
+def compare(results, baseline):
+    print(f"\nCompared to {baseline['commit']}:")
+    for name, timings in results["scenarios"].items():
+        previous = baseline["scenarios"].get(name)
+        if not previous:
+            continue
+        changes = []
+        for metric in ("p50_ms", "p95_ms", "p99_ms"):
+            if previous[metric]:
+                change = (timings[metric] / previous[metric] - 1) * 100
+                changes.append(f"{metric[:3]} {change:+6.1f}%")
+        print(f"{name:<22} {'  '.join(changes)}")
+    previous = baseline.get("startup")
+    if results.get("startup") and previous:
+        for metric in ("import_app_ms", "create_app_ms"):
+            change = (results["startup"][metric] / previous[metric] - 1) * 100
+            print(f"{metric:<22} {change:+6.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mongo-uri',
+                        default=os.environ.get('BENCH_MONGO_URI'))
+    parser.add_argument('--mongomock', action='store_true')
+    parser.add_argument('--books', type=int, default=1000)
+    parser.add_argument('--authors', type=int, default=100)
+    parser.add_argument('--genres', type=int, default=20)
+    parser.add_argument('--ratings-per-book', type=int, default=10)
+    parser.add_argument('--comments-per-book', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--startup-repeat', type=int, default=5,
+                        help='processes started to time the cold start '
+                             '(0 to skip)')
+    parser.add_argument('--cache', action='store_true',
+                        help='keep the page cache on')
+    parser.add_argument('--output', help='file to save the results to')
+    parser.add_argument('--baseline', help='results of a previous run')
+    args = parser.parse_args()
+    if not args.mongo_uri and not args.mongomock:
+        parser.error("set --mongo-uri (or BENCH_MONGO_URI) or --mongomock")
+
+    app = create_app({
+        "MONGO_URI": args.mongo_uri or "mongodb://localhost/booksters_bench",
+        "SECRET_KEY": "benchmark",
+        "CACHE_TYPE": "lru" if args.cache else "null",
+        "RATE_LIMIT_ENABLED": False,
+        "TESTING": True
+    })
+    if args.mongomock:
+        import mongomock
+        mongo.cx = mongomock.MongoClient()
+        mongo.db = mongo.cx.booksters_bench
+    authors, genres = seed_catalogue(
+        mongo.db, args.books, args.authors, args.genres,
+        args.ratings_per_book, args.comments_per_book)
+    if not args.mongomock:
+        init_indexes()
+    book = mongo.db.books.find_one()
+    search_word = book["book_title"].split()[0]
+
+    results = {
+        "commit": git_commit(),
+        "date": datetime.now().isoformat(timespec='seconds'),
+        "parameters": {
+            key: value for key, value in vars(args).items()
+            if key not in ("output", "baseline", "mongo_uri")
+        },
+        "scenarios": {}
+    }
+    client = app.test_client()
+    for name, function in scenarios(client, authors, genres,
+                                    book["_id"], search_word).items():
+        try:
+            # the stats helpers read with the settings of the app
+            with app.app_context():
+                timings = measure(function, args.repeat)
+        except Exception as error:
+            print(f"{name:<22} skipped: {error!r}")
+            continue
+        results["scenarios"][name] = timings
+        print(f"{name:<22} p50 {timings['p50_ms']:8.2f} ms"
+              f"  p95 {timings['p95_ms']:8.2f} ms"
+              f"  p99 {timings['p99_ms']:8.2f} ms"
+              f"  peak {timings['peak_memory_kib']:9.1f} KiB")
+
+    if args.startup_repeat:
+        results["startup"] = startup_times(args.startup_repeat)
+        print(f"{'import_app':<22} {results['startup']['import_app_ms']:8.1f}"
+              f" ms  create_app {results['startup']['create_app_ms']:8.1f} ms")
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            compare(results, json.load(baseline))
+
+
+if __name__ == '__main__':
+    main()
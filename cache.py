@@ -0,0 +1,247 @@
+import gzip
+import hashlib
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import make_response, request, session
+from pymongo import UpdateOne
+
+
+# In-process cache that evicts the least recently used entries
+# and the entries older than their time to live
+class LRUCache:
+
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires < time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + ttl if ttl else None
+        with self.lock:
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+# Cache shared by all the workers, stored in a Redis compatible server
+class RedisCache:
+
+    def __init__(self, url, prefix="booksters:"):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is not None:
+            return pickle.loads(value)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, pickle.dumps(value), ex=ttl)
+
+    def clear(self):
+        keys = self.client.scan_iter(match=self.prefix + "*")
+        for key in keys:
+            self.client.delete(key)
+
+
+# Cache that stores nothing, used to switch caching off
+class NullCache:
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl=None):
+        pass
+
+    def clear(self):
+        pass
+
+
+# Times of the last write to the data of each tag, kept in the cache
+# backend. A tag unknown to the backend (never written or evicted)
+# starts now, which invalidates the pages cached before
+class BackendTags:
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def times(self, tags):
+        times = {}
+        for tag in tags:
+            written = self.backend.get("tag:" + tag)
+            if written is None:
+                written = time.time()
+                self.backend.set("tag:" + tag, written)
+            times[tag] = written
+        return times
+
+    def invalidate(self, tags, written):
+        for tag in tags:
+            self.backend.set("tag:" + tag, written)
+
+
+# Times of the last write to the data of each tag, kept in a MongoDB
+# collection so that the workers keeping their pages in memory all see
+# the invalidations of the others. A page reads the times of its tags
+# with a single query on _id
+class MongoTags:
+
+    def __init__(self, get_db, collection="page_cache_tags"):
+        self.get_db = get_db
+        self.collection = collection
+
+    def times(self, tags):
+        collection = self.get_db()[self.collection]
+        times = {tag["_id"]: tag["written"]
+                 for tag in collection.find({"_id": {"$in": tags}})}
+        for tag in tags:
+            if tag not in times:
+                times[tag] = time.time()
+                collection.update_one(
+                    {"_id": tag}, {"$setOnInsert": {"written": times[tag]}},
+                    upsert=True)
+        return times
+
+    # $max keeps the latest time when the clocks of the workers differ
+    def invalidate(self, tags, written):
+        self.get_db()[self.collection].bulk_write([
+            UpdateOne({"_id": tag}, {"$max": {"written": written}},
+                      upsert=True)
+            for tag in tags
+        ], ordered=False)
+
+
+# Caches rendered pages, tagged with the data they show.
+# Writing to some data invalidates the tag, and with it every page
+# showing that data. The time of the last write of each tag is kept in
+# the Redis backend when the pages are, and in MongoDB (get_db) with the
+# in-process backend, so an invalidation in one worker is seen by all of
+# them on their next request.
+class PageCache:
+
+    def __init__(self, app=None, get_db=None):
+        self.backend = NullCache()
+        self.tags = BackendTags(self.backend)
+        self.ttl = None
+        if app is not None:
+            self.init_app(app, get_db)
+
+    def init_app(self, app, get_db=None):
+        app.config.setdefault('CACHE_TYPE', 'lru')
+        app.config.setdefault('CACHE_TTL', 300)
+        app.config.setdefault('CACHE_MAX_ENTRIES', 512)
+        app.config.setdefault('CACHE_REDIS_URL', None)
+        cache_type = app.config['CACHE_TYPE']
+        if cache_type == 'redis':
+            self.backend = RedisCache(app.config['CACHE_REDIS_URL'])
+        elif cache_type == 'lru':
+            self.backend = LRUCache(app.config['CACHE_MAX_ENTRIES'])
+        else:
+            self.backend = NullCache()
+        if cache_type == 'lru' and get_db is not None:
+            self.tags = MongoTags(get_db)
+        else:
+            self.tags = BackendTags(self.backend)
+        self.ttl = app.config['CACHE_TTL']
+
+    # invalidates every page showing the data of the tags
+    def invalidate(self, *tags):
+        self.tags.invalidate(tags, time.time())
+
+    def clear(self):
+        self.backend.clear()
+
+    # Decorator caching the page of a view, tagged with the tags given.
+    # A tag can be a function of the view arguments, e.g.
+    # lambda book_id: f"book:{book_id}".
+    # Responses carry an ETag and a Last-Modified date so browsers can
+    # revalidate their copy and get a 304 when nothing has changed.
+    # With compress=True a gzip copy of the page is cached as well and
+    # sent to the clients accepting it.
+    # A streamed page is sent as it is rendered and cached once the
+    # whole page has been sent.
+    def cached(self, *tags, compress=False):
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                # pages showing flash messages are never cached
+                if request.method != 'GET' or session.get('_flashes'):
+                    return view(*args, **kwargs)
+                view_tags = [tag(**kwargs) if callable(tag) else tag
+                             for tag in tags]
+                last_modified = max(self.tags.times(view_tags).values())
+                key = "page:" + request.full_path
+                page = self.backend.get(key)
+                if page is None or page["last_modified"] < last_modified:
+                    response = make_response(view(*args, **kwargs))
+                    if (response.status_code != 200
+                            or response.direct_passthrough):
+                        return response
+                    if response.is_streamed:
+                        response.response = self.store_stream(
+                            key, response.response, response.charset,
+                            response.mimetype, last_modified, compress)
+                        return response
+                    page = self.store(key, response.get_data(),
+                                      response.mimetype, last_modified,
+                                      compress)
+                return self.conditional_response(page)
+            return wrapper
+        return decorator
+
+    def store(self, key, body, mimetype, last_modified, compress):
+        page = {
+            "body": body,
+            "gzip_body": gzip.compress(body) if compress else None,
+            "mimetype": mimetype,
+            "etag": hashlib.md5(body).hexdigest(),
+            "last_modified": last_modified
+        }
+        self.backend.set(key, page, self.ttl)
+        return page
+
+    # sends the chunks of a streamed page, then caches the whole page
+    def store_stream(self, key, chunks, charset, mimetype, last_modified,
+                     compress):
+        body = []
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode(charset)
+            body.append(chunk)
+            yield chunk
+        self.store(key, b"".join(body), mimetype, last_modified, compress)
+
+    def conditional_response(self, page):
+        response = make_response(page["body"])
+        response.mimetype = page["mimetype"]
+        response.set_etag(page["etag"])
+        if page["gzip_body"] is not None:
+            response.vary.add('Accept-Encoding')
+            if 'gzip' in request.headers.get('Accept-Encoding', ''):
+                response.set_data(page["gzip_body"])
+                response.content_encoding = 'gzip'
+                response.set_etag(page["etag"] + "-gzip")
+        response.last_modified = page["last_modified"]
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
@@ -0,0 +1,37 @@
+# gunicorn settings, each one can be overridden by an environment variable
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+
+# worker processes, each serving requests with a pool of threads
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+
+# with the gevent workers each request runs in a greenlet, and a worker
+# holds up to worker_connections requests waiting on MongoDB at once.
+# The standard library is patched before the app is loaded, so that
+# pymongo sockets and the app locks and threads cooperate with gevent
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
+if worker_class == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
+# loads the app once in the master before forking the workers; the Mongo
+# client only connects on its first query, so each worker opens its own
+# connections after the fork
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'true').lower() == 'true'
+
+# seconds an idle connection is kept open for the next request
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+
+# seconds a request can take before its worker is restarted, and seconds
+# given to the workers to finish their requests on restart or shutdown
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+
+# restarts each worker after a number of requests, to bound memory growth
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 100))
+
+accesslog = '-'
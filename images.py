@@ -0,0 +1,91 @@
+import json
+import os
+import posixpath
+import shutil
+from assets import fingerprinted
+
+
+# images of the static folder given resized variants
+IMAGES = ["img/home-bg.jpg"]
+
+# widths of the variants, in pixels. An image is never enlarged
+IMAGE_WIDTHS = (640, 1280, 1920, 2560)
+
+# formats of the variants, from the preferred one, with their encoder
+# settings. AVIF is skipped when Pillow cannot write it, as with the
+# Pillow 7.0.0 of requirements.txt
+IMAGE_FORMATS = {
+    "avif": {"format": "AVIF", "quality": 50},
+    "webp": {"format": "WEBP", "quality": 80, "method": 6},
+    "jpeg": {"format": "JPEG", "quality": 80, "optimize": True,
+             "progressive": True}
+}
+
+
+# Formats Pillow can write, among IMAGE_FORMATS. Older versions of Pillow
+# write AVIF with the pillow-avif-plugin package
+def available_formats():
+    from PIL import Image
+    try:
+        import pillow_avif  # noqa: F401
+    except ImportError:
+        pass
+    Image.init()
+    return [name for name, settings in IMAGE_FORMATS.items()
+            if settings["format"] in Image.SAVE]
+
+
+# Encodes an image with the settings of a format, returns its bytes
+def encode(image, settings):
+    from io import BytesIO
+    output = BytesIO()
+    image.save(output, **settings)
+    return output.getvalue()
+
+
+# Builds the resized variants of the images in the images folder of the
+# output folder (a folder of the static folder) and writes their
+# manifest, images.json. Returns, for every image, its size and the size
+# of every variant
+def build_images(static_folder, output="dist", images=IMAGES,
+                 widths=IMAGE_WIDTHS):
+    from PIL import Image
+    output_folder = os.path.join(static_folder, output, "img")
+    # the variants of the previous builds are replaced
+    shutil.rmtree(output_folder, ignore_errors=True)
+    os.makedirs(output_folder)
+    formats = available_formats()
+    manifest = {}
+    report = {}
+    for name in images:
+        path = os.path.join(static_folder, name)
+        with Image.open(path) as original:
+            original.load()
+        image = original.convert("RGB")
+        entry = manifest[name] = {
+            "width": image.width,
+            "height": image.height,
+            "variants": {image_format: [] for image_format in formats}
+        }
+        report[name] = {"original": os.path.getsize(path), "variants": {}}
+        image_widths = sorted({min(width, image.width) for width in widths})
+        stem = posixpath.splitext(posixpath.basename(name))[0]
+        for width in image_widths:
+            height = round(image.height * width / image.width)
+            resized = image.resize((width, height), Image.LANCZOS)
+            for image_format in formats:
+                content = encode(resized, IMAGE_FORMATS[image_format])
+                file_name = fingerprinted(
+                    f"{stem}-{width}.{image_format}", content)
+                with open(os.path.join(output_folder, file_name),
+                          'wb') as variant:
+                    variant.write(content)
+                entry["variants"][image_format].append(
+                    [width, f"{output}/img/{file_name}"])
+                report[name]["variants"][f"{image_format} {width}w"] = (
+                    len(content))
+    # the formats are kept in order of preference
+    with open(os.path.join(static_folder, output, "images.json"),
+              'w') as file:
+        json.dump(manifest, file, indent=2)
+    return report
@@ -0,0 +1,261 @@
+import threading
+import time
+from flask import current_app, g, request
+from flask.signals import before_render_template, template_rendered
+from pymongo import monitoring
+
+
+# upper bounds, in seconds, of the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+# Short description of a Mongo command for the slow request log,
+# e.g. "find books {'book_author': 'x'}"
+def describe_command(command_name, command):
+    target = command.get(command_name)
+    details = (command.get("filter") or command.get("q")
+               or command.get("pipeline") or command.get("updates")
+               or command.get("query") or "")
+    description = f"{command_name} {target}"
+    if details:
+        description += f" {details}"
+    return description[:300]
+
+
+# pymongo command listener adding every command run while a request is
+# served to the metrics of that request. Commands are reported on the
+# thread that runs them, so commands of background threads (e.g. the
+# search index refresh) are not counted in any request.
+class QueryListener(monitoring.CommandListener):
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def started(self, event):
+        queries = self.metrics.current_queries()
+        if queries is not None:
+            queries.append({
+                "request_id": event.request_id,
+                "command": describe_command(event.command_name,
+                                            event.command),
+                "seconds": None
+            })
+
+    def succeeded(self, event):
+        self.finished(event)
+
+    def failed(self, event):
+        self.finished(event)
+
+    def finished(self, event):
+        queries = self.metrics.current_queries()
+        if queries is None:
+            return
+        for query in reversed(queries):
+            if query["request_id"] == event.request_id:
+                query["seconds"] = event.duration_micros / 1e6
+                return
+
+
+# Records, for every endpoint, the number of requests, their latency,
+# the number of Mongo commands they run, the time spent in MongoDB and
+# the time spent rendering templates. Serves them in the Prometheus text
+# format and logs the requests slower than METRICS_SLOW_REQUEST_MS with
+# the commands they ran. A streamed response is recorded once it has been
+# sent, with the commands run and the time spent while it streamed.
+# Metrics are kept in the memory of each worker process.
+class RequestMetrics:
+
+    def __init__(self, app=None):
+        self.listener = QueryListener(self)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.slow_request_seconds = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_SLOW_REQUEST_MS', 500)
+        self.slow_request_seconds = (
+            app.config['METRICS_SLOW_REQUEST_MS'] / 1000)
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+        app.teardown_request(self.teardown_request)
+        before_render_template.connect(self.start_render, app)
+        template_rendered.connect(self.finish_render, app)
+
+    # Mongo commands run so far by the request served on this thread,
+    # None outside of a request
+    def current_queries(self):
+        return getattr(self.local, "queries", None)
+
+    # wraps a function run on another thread for the current request, so
+    # that its Mongo commands are counted in the request
+    def track(self, function):
+        queries = self.current_queries()
+
+        def tracked(*args, **kwargs):
+            self.local.queries = queries
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.local.queries = None
+        return tracked
+
+    def start_request(self):
+        self.local.queries = []
+        g.metrics_render_seconds = 0
+        g.metrics_started = time.perf_counter()
+
+    def start_render(self, app, template, context, **extra):
+        g.metrics_render_started = time.perf_counter()
+
+    def finish_render(self, app, template, context, **extra):
+        started = g.pop('metrics_render_started', None)
+        if started is not None:
+            g.metrics_render_seconds += time.perf_counter() - started
+
+    def finish_request(self, response):
+        started = g.get('metrics_started')
+        queries = self.current_queries()
+        if started is None or queries is None:
+            self.local.queries = None
+            return response
+        # what is needed to record the request once its context is gone
+        served = {
+            "endpoint": request.endpoint or "unknown",
+            "request": f"{request.method} {request.full_path}",
+            "status_code": response.status_code,
+            "logger": current_app.logger
+        }
+        render_seconds = g.metrics_render_seconds
+        if response.is_streamed and not response.direct_passthrough:
+            # the commands run while the page streams are still added to
+            # the queries of the request, until its context is torn down
+            response.response = self.finish_stream(
+                response.response, served, started, queries, render_seconds)
+            return response
+        self.local.queries = None
+        self.finish(served, started, queries, render_seconds)
+        return response
+
+    # Yields the chunks of a streamed response, then records the request.
+    # The time spent producing the chunks outside of MongoDB is counted as
+    # rendering time, since streamed templates send no render signals
+    def finish_stream(self, chunks, served, started, queries,
+                      render_seconds):
+        queries_before = len(queries)
+        producing_seconds = 0
+        chunk_started = time.perf_counter()
+        try:
+            for chunk in chunks:
+                producing_seconds += time.perf_counter() - chunk_started
+                yield chunk
+                chunk_started = time.perf_counter()
+            producing_seconds += time.perf_counter() - chunk_started
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+            stream_db_seconds = sum(query["seconds"] or 0
+                                    for query in queries[queries_before:])
+            render_seconds += max(producing_seconds - stream_db_seconds, 0)
+            self.finish(served, started, queries, render_seconds)
+
+    def finish(self, served, started, queries, render_seconds):
+        seconds = time.perf_counter() - started
+        db_seconds = sum(query["seconds"] or 0 for query in queries)
+        self.record(served["endpoint"], seconds, len(queries), db_seconds,
+                    render_seconds)
+        if seconds >= self.slow_request_seconds:
+            self.log_slow_request(served, seconds, queries, db_seconds,
+                                  render_seconds)
+
+    # stops collecting the commands of a request that ended in an error
+    def teardown_request(self, error=None):
+        self.local.queries = None
+
+    def record(self, endpoint, seconds, query_count, db_seconds,
+               render_seconds):
+        with self.lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = {
+                    "requests": 0,
+                    "seconds": 0,
+                    "buckets": [0] * len(LATENCY_BUCKETS),
+                    "queries": 0,
+                    "db_seconds": 0,
+                    "render_seconds": 0,
+                    "slow_requests": 0
+                }
+            stats["requests"] += 1
+            stats["seconds"] += seconds
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    stats["buckets"][index] += 1
+            stats["queries"] += query_count
+            stats["db_seconds"] += db_seconds
+            stats["render_seconds"] += render_seconds
+            if seconds >= self.slow_request_seconds:
+                stats["slow_requests"] += 1
+
+    def log_slow_request(self, served, seconds, queries, db_seconds,
+                         render_seconds):
+        lines = [
+            f"Slow request {served['request']}"
+            f" ({served['status_code']}): {seconds * 1000:.0f} ms,"
+            f" {len(queries)} Mongo commands taking"
+            f" {db_seconds * 1000:.0f} ms,"
+            f" {render_seconds * 1000:.0f} ms rendering templates"
+        ]
+        for query in queries:
+            duration = ("failed" if query["seconds"] is None
+                        else f"{query['seconds'] * 1000:.1f} ms")
+            lines.append(f"  {duration:>10}  {query['command']}")
+        served["logger"].warning("\n".join(lines))
+
+    def clear(self):
+        with self.lock:
+            self.endpoints = {}
+
+    # metrics of every endpoint in the Prometheus text exposition format
+    def prometheus(self):
+        with self.lock:
+            endpoints = {endpoint: dict(stats, buckets=list(stats["buckets"]))
+                         for endpoint, stats in self.endpoints.items()}
+        lines = []
+
+        def metric(name, kind, help_text, field):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for endpoint, stats in sorted(endpoints.items()):
+                lines.append(f'{name}{{endpoint="{endpoint}"}} {stats[field]}')
+
+        metric("booksters_requests_total", "counter",
+               "Requests served.", "requests")
+        lines.append("# HELP booksters_request_duration_seconds "
+                     "Time taken to serve the requests.")
+        lines.append("# TYPE booksters_request_duration_seconds histogram")
+        for endpoint, stats in sorted(endpoints.items()):
+            name = "booksters_request_duration_seconds"
+            for bound, count in zip(LATENCY_BUCKETS, stats["buckets"]):
+                lines.append(f'{name}_bucket{{endpoint="{endpoint}",'
+                             f'le="{bound}"}} {count}')
+            lines.append(f'{name}_bucket{{endpoint="{endpoint}",'
+                         f'le="+Inf"}} {stats["requests"]}')
+            lines.append(f'{name}_sum{{endpoint="{endpoint}"}} '
+                         f'{stats["seconds"]}')
+            lines.append(f'{name}_count{{endpoint="{endpoint}"}} '
+                         f'{stats["requests"]}')
+        metric("booksters_mongo_commands_total", "counter",
+               "Mongo commands run while serving the requests.", "queries")
+        metric("booksters_mongo_duration_seconds_total", "counter",
+               "Time spent in MongoDB while serving the requests.",
+               "db_seconds")
+        metric("booksters_template_render_seconds_total", "counter",
+               "Time spent rendering templates.", "render_seconds")
+        metric("booksters_slow_requests_total", "counter",
+               "Requests slower than the slow request threshold.",
+               "slow_requests")
+        return "\n".join(lines) + "\n"
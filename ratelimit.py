@@ -0,0 +1,270 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import current_app, request
+from pymongo import monitoring
+
+
+# seconds in each unit of a limit such as "10/minute"
+PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+
+
+# Reads a limit such as "10/minute" as a refill rate, in tokens per
+# second, and a burst, the tokens a full bucket holds. An empty limit
+# or "0" means no limit
+def parse_limit(limit):
+    if not limit or limit == "0":
+        return None
+    count, _, period = limit.partition("/")
+    return int(count) / PERIODS[period or "second"], int(count)
+
+
+# Token buckets kept in the memory of the worker. The least recently used
+# buckets are dropped beyond max_entries; a bucket left unused that long
+# would be full again anyway
+class MemoryBuckets:
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    # takes a token from each of the buckets, given as (key, rate, burst),
+    # when they all hold one. Returns 0 when the tokens were taken or the
+    # seconds until the buckets hold one again, without taking any
+    def take(self, buckets):
+        now = time.monotonic()
+        with self.lock:
+            levels = []
+            for key, rate, burst in buckets:
+                tokens, updated = self.buckets.get(key, (burst, now))
+                levels.append(min(burst, tokens + (now - updated) * rate))
+            wait = max([(1 - tokens) / rate for tokens, (key, rate, burst)
+                        in zip(levels, buckets) if tokens < 1], default=0)
+            for tokens, (key, rate, burst) in zip(levels, buckets):
+                if not wait:
+                    tokens -= 1
+                self.buckets[key] = (tokens, now)
+                self.buckets.move_to_end(key)
+            while len(self.buckets) > self.max_entries:
+                self.buckets.popitem(last=False)
+            return wait
+
+    def clear(self):
+        with self.lock:
+            self.buckets.clear()
+
+
+# refills the buckets stored as Redis hashes and takes a token from each
+# of them when they all hold one, in a single step so that workers
+# sharing the buckets do not race. ARGV holds the time, then the rate and
+# burst of each bucket of KEYS
+TAKE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local levels = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[2 * i])
+    local burst = tonumber(ARGV[2 * i + 1])
+    local bucket = redis.call('HMGET', key, 'tokens', 'updated')
+    local tokens = tonumber(bucket[1]) or burst
+    local updated = tonumber(bucket[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+    if tokens < 1 then
+        wait = math.max(wait, (1 - tokens) / rate)
+    end
+    levels[i] = tokens
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[2 * i])
+    local burst = tonumber(ARGV[2 * i + 1])
+    local tokens = levels[i]
+    if wait == 0 then
+        tokens = tokens - 1
+    end
+    redis.call('HMSET', key, 'tokens', tokens, 'updated', now)
+    redis.call('EXPIRE', key, math.ceil(burst / rate) + 1)
+end
+return tostring(wait)
+"""
+
+
+# Token buckets shared by all the workers of all the nodes, stored in a
+# Redis compatible server. The time is taken from the worker clocks
+class RedisBuckets:
+
+    def __init__(self, url, prefix="booksters:ratelimit:"):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.script = self.client.register_script(TAKE_SCRIPT)
+        self.prefix = prefix
+
+    def take(self, buckets):
+        args = [time.time()]
+        for key, rate, burst in buckets:
+            args += [rate, burst]
+        return float(self.script(
+            keys=[self.prefix + key for key, rate, burst in buckets],
+            args=args))
+
+    def clear(self):
+        for key in self.client.scan_iter(match=self.prefix + "*"):
+            self.client.delete(key)
+
+
+# pymongo command listener keeping a moving average of the time MongoDB
+# takes to answer the commands of the worker. getMore commands are left
+# out, since those of the change stream wait for changes by design
+class LatencyListener(monitoring.CommandListener):
+
+    def __init__(self, weight=0.1):
+        self.weight = weight
+        self.seconds = 0
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        if event.command_name != "getMore":
+            self.seconds += self.weight * (
+                event.duration_micros / 1e6 - self.seconds)
+
+    def failed(self, event):
+        self.succeeded(event)
+
+
+# Limits the requests of the routes that are cheap to send but expensive
+# for MongoDB (votes, comments, searches), by group of routes. Each group
+# has a token bucket per client IP and a bucket for all the clients,
+# configured with RATE_LIMIT_<GROUP> and RATE_LIMIT_<GROUP>_GLOBAL,
+# e.g. "10/minute". A request finding a bucket empty gets a 429 with a
+# Retry-After header. The buckets are kept in each worker, or shared by
+# all of them in Redis with RATE_LIMIT_STORAGE=redis.
+# While MongoDB answers slower than SHED_LATENCY_MS on average, a worker
+# serves at most SHED_MAX_CONCURRENT requests of these routes at once and
+# answers the others with a 503, so that a flood of them does not slow
+# down the other pages.
+# The client IP is only read from X-Forwarded-For with TRUSTED_PROXIES;
+# a worker logs a warning once when requests carry the header without it,
+# since every client then shares the IP of the proxy.
+class RateLimiter:
+
+    def __init__(self, app=None):
+        self.backend = MemoryBuckets()
+        self.latency_listener = LatencyListener()
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.rejected = {}
+        self.warned_proxies = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('RATE_LIMIT_ENABLED', True)
+        app.config.setdefault('RATE_LIMIT_STORAGE', 'memory')
+        app.config.setdefault('RATE_LIMIT_REDIS_URL', None)
+        app.config.setdefault('SHED_LATENCY_MS', 250)
+        app.config.setdefault('SHED_MAX_CONCURRENT', 8)
+        if app.config['RATE_LIMIT_STORAGE'] == 'redis':
+            self.backend = RedisBuckets(app.config['RATE_LIMIT_REDIS_URL'])
+        else:
+            self.backend = MemoryBuckets()
+
+    # Decorator limiting the requests of a view, counted in the buckets
+    # of the group
+    def limit(self, group):
+        def decorator(view):
+            @wraps(view)
+            def limited_view(*args, **kwargs):
+                config = current_app.config
+                if not config['RATE_LIMIT_ENABLED']:
+                    return view(*args, **kwargs)
+                self.check_proxies(config)
+                wait = self.wait(group, config)
+                if wait:
+                    self.count(group, "rate_limited")
+                    return ("Too many requests, please try again in a "
+                            "moment.",
+                            429, {"Retry-After": str(math.ceil(wait))})
+                if not self.enter(config):
+                    self.count(group, "shed")
+                    return ("The site is busy at the moment, please try "
+                            "again in a few seconds.",
+                            503, {"Retry-After": "1"})
+                try:
+                    return view(*args, **kwargs)
+                finally:
+                    with self.lock:
+                        self.in_flight -= 1
+            return limited_view
+        return decorator
+
+    # warns when the requests come through a proxy that is not trusted
+    def check_proxies(self, config):
+        if self.warned_proxies or config.get('TRUSTED_PROXIES') or \
+                "X-Forwarded-For" not in request.headers:
+            return
+        self.warned_proxies = True
+        current_app.logger.warning(
+            "Requests carry X-Forwarded-For but TRUSTED_PROXIES is 0: the "
+            "rate limits see every client as %s", request.remote_addr)
+
+    # seconds the client has to wait before a request of the group is
+    # allowed, 0 when it is allowed now. A token is only taken from the
+    # client and global buckets when both hold one
+    def wait(self, group, config):
+        name = group.upper()
+        buckets = []
+        for key, limit in (
+            (f"{group}:ip:{request.remote_addr}",
+             config.get(f'RATE_LIMIT_{name}')),
+            (f"{group}:global", config.get(f'RATE_LIMIT_{name}_GLOBAL'))
+        ):
+            limit = parse_limit(limit)
+            if limit is not None:
+                buckets.append((key, *limit))
+        if not buckets:
+            return 0
+        return self.backend.take(buckets)
+
+    # counts a request in the ones being served, unless MongoDB is slow
+    # and the worker is already serving as many as allowed
+    def enter(self, config):
+        overloaded = (self.latency_listener.seconds * 1000
+                      > config['SHED_LATENCY_MS'])
+        with self.lock:
+            if overloaded and self.in_flight >= config['SHED_MAX_CONCURRENT']:
+                return False
+            self.in_flight += 1
+            return True
+
+    def count(self, group, reason):
+        with self.lock:
+            self.rejected[group, reason] = (
+                self.rejected.get((group, reason), 0) + 1)
+
+    def clear(self):
+        self.backend.clear()
+        with self.lock:
+            self.rejected = {}
+
+    # rejected requests and Mongo latency in the Prometheus text format
+    def prometheus(self):
+        with self.lock:
+            rejected = dict(self.rejected)
+        lines = [
+            "# HELP booksters_rejected_requests_total "
+            "Requests rate limited (429) or shed (503).",
+            "# TYPE booksters_rejected_requests_total counter"
+        ]
+        for (group, reason), count in sorted(rejected.items()):
+            lines.append(f'booksters_rejected_requests_total{{group="{group}",'
+                         f'reason="{reason}"}} {count}')
+        lines.append("# HELP booksters_mongo_latency_seconds "
+                     "Moving average of the time taken by Mongo commands.")
+        lines.append("# TYPE booksters_mongo_latency_seconds gauge")
+        lines.append(f"booksters_mongo_latency_seconds "
+                     f"{self.latency_listener.seconds}")
+        return "\n".join(lines) + "\n"
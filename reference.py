@@ -0,0 +1,176 @@
+import threading
+import time
+from pymongo.errors import OperationFailure, PyMongoError
+
+
+# collections held in memory, with the field naming their documents
+NAME_FIELDS = {"authors": "author_name", "genres": "genre_name"}
+
+# error code of a change stream opened on a standalone server
+CHANGE_STREAM_NOT_SUPPORTED = 40573
+
+
+# In-memory copy of the authors and genres, the reference data of the
+# dropdowns and lists of the app, so that pages do not query them.
+# It is loaded by the first page using it and kept up to date by a
+# thread of each worker following a change stream of the two
+# collections, so that the changes made by every worker of every node
+# show up within moments. On a standalone server, which has no change
+# streams, the thread reloads them every poll_seconds instead.
+# on_change is called with the name of a collection when its names
+# change, e.g. to drop the pages listing them.
+class ReferenceData:
+
+    def __init__(self, app=None, get_db=None):
+        self.app = None
+        self.get_db = get_db
+        self.lock = threading.Lock()
+        self.loaded = threading.Event()
+        self.documents = {collection: {} for collection in NAME_FIELDS}
+        self.lists = {}
+        self.watcher = None
+        self.on_change = None
+        if app is not None:
+            self.init_app(app, get_db)
+
+    def init_app(self, app, get_db):
+        app.config.setdefault('REFERENCE_CHANGE_STREAMS', True)
+        app.config.setdefault('REFERENCE_POLL_SECONDS', 30)
+        self.app = app
+        self.get_db = get_db
+        self.change_streams = app.config['REFERENCE_CHANGE_STREAMS']
+        self.poll_seconds = app.config['REFERENCE_POLL_SECONDS']
+
+    # authors and genres, in the order they were added
+    def authors(self):
+        return self.list("authors")
+
+    def genres(self):
+        return self.list("genres")
+
+    def list(self, collection):
+        self.ensure_watching()
+        # the first pages wait for the thread to load the data, and load
+        # it themselves when it takes too long
+        if not self.loaded.wait(timeout=2):
+            self.load()
+        with self.lock:
+            documents = self.lists.get(collection)
+            if documents is None:
+                documents = self.lists[collection] = sorted(
+                    self.documents[collection].values(),
+                    key=lambda document: document["_id"])
+            return documents
+
+    # reads both collections from the DB
+    def load(self):
+        db = self.get_db()
+        documents = {
+            collection: {document["_id"]: document
+                         for document in db[collection].find()}
+            for collection in NAME_FIELDS
+        }
+        with self.lock:
+            changed = [
+                collection for collection in NAME_FIELDS
+                if self.names(collection, self.documents[collection])
+                != self.names(collection, documents[collection])
+            ]
+            self.documents = documents
+            self.lists = {}
+        was_loaded = self.loaded.is_set()
+        self.loaded.set()
+        if was_loaded:
+            self.changed(*changed)
+
+    # name of every document of a collection, by id
+    @staticmethod
+    def names(collection, documents):
+        name_field = NAME_FIELDS[collection]
+        return {document_id: document.get(name_field)
+                for document_id, document in documents.items()}
+
+    # adds or replaces a document, e.g. right after this worker wrote it
+    def store(self, collection, document):
+        name_field = NAME_FIELDS[collection]
+        with self.lock:
+            previous = self.documents[collection].get(document["_id"])
+            self.documents[collection][document["_id"]] = document
+            self.lists.pop(collection, None)
+        if previous is None or previous.get(name_field) != document.get(
+                name_field):
+            self.changed(collection)
+
+    def discard(self, collection, document_id):
+        with self.lock:
+            removed = self.documents[collection].pop(document_id, None)
+            self.lists.pop(collection, None)
+        if removed is not None:
+            self.changed(collection)
+
+    def changed(self, *collections):
+        if self.on_change is not None:
+            for collection in collections:
+                self.on_change(collection)
+
+    # applies an event of the change stream
+    def apply(self, change):
+        collection = change["ns"]["coll"]
+        operation = change["operationType"]
+        if operation in ("insert", "update", "replace"):
+            # the document may be deleted already, the delete follows
+            if change.get("fullDocument") is not None:
+                self.store(collection, change["fullDocument"])
+        elif operation == "delete":
+            self.discard(collection, change["documentKey"]["_id"])
+        else:
+            # the collection was dropped or renamed
+            self.load()
+
+    # starts the thread following the changes, on the first use in the
+    # worker, so that it is never started before a fork
+    def ensure_watching(self):
+        with self.lock:
+            if self.watcher is None or not self.watcher.is_alive():
+                self.watcher = threading.Thread(target=self.watch,
+                                                daemon=True)
+                self.watcher.start()
+
+    def watch(self):
+        with self.app.app_context():
+            while True:
+                try:
+                    if self.change_streams:
+                        self.follow_changes()
+                    else:
+                        self.poll()
+                except OperationFailure as error:
+                    if error.code == CHANGE_STREAM_NOT_SUPPORTED:
+                        self.app.logger.info(
+                            "Change streams are not available, the authors"
+                            " and genres are reloaded every"
+                            f" {self.poll_seconds} seconds")
+                        self.change_streams = False
+                    else:
+                        self.app.logger.exception(
+                            "The authors and genres are not followed")
+                        time.sleep(1)
+                except PyMongoError:
+                    self.app.logger.exception(
+                        "The authors and genres are not followed")
+                    time.sleep(1)
+
+    def follow_changes(self):
+        pipeline = [{"$match": {"ns.coll": {"$in": list(NAME_FIELDS)}}}]
+        with self.get_db().watch(pipeline,
+                                 full_document="updateLookup") as stream:
+            # loaded once the stream is open, so that no change made in
+            # between is missed
+            self.load()
+            for change in stream:
+                self.apply(change)
+
+    def poll(self):
+        while True:
+            self.load()
+            time.sleep(self.poll_seconds)
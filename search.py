@@ -0,0 +1,232 @@
+import re
+import threading
+import time
+import unicodedata
+from bisect import bisect_left, insort
+
+
+# Splits a text in lowercase words without accents
+def tokenize(text):
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return re.findall(r'\w+', text)
+
+
+# Returns the 3 letters sequences of a word, padded to match its edges
+def trigrams(word):
+    padded = f"  {word} "
+    return {padded[i:i+3] for i in range(len(padded) - 2)}
+
+
+# In-memory index of the titles and authors of the books, used for
+# autocomplete (prefix search) and for typo tolerant search.
+# Words are kept in a sorted list, so the words starting with a prefix
+# are a contiguous range found by bisection. Each word of the
+# vocabulary is also indexed by its trigrams, to find the words that
+# are close to a misspelled one.
+class SearchIndex:
+
+    def __init__(self, max_age=300):
+        self.max_age = max_age
+        self.loaded_at = None
+        self.lock = threading.RLock()
+        self.refreshing = False
+        self.clear()
+
+    def clear(self):
+        self.books = {}
+        self.words = []
+        self.word_books = {}
+        self.word_trigrams = {}
+        self.trigram_words = {}
+
+    # rebuilds the index from an iterable of books
+    def load(self, books):
+        with self.lock:
+            self.clear()
+            for book in books:
+                self.add(book)
+            self.loaded_at = time.time()
+
+    # loads the index on first use, and reloads it in the background
+    # once it is older than max_age, so that books written by other
+    # workers show up as well
+    def ensure_loaded(self, load_books):
+        if self.loaded_at is None:
+            self.load(load_books())
+        elif (time.time() - self.loaded_at > self.max_age
+                and not self.refreshing):
+            self.refreshing = True
+
+            def refresh():
+                try:
+                    self.load(load_books())
+                finally:
+                    self.refreshing = False
+
+            threading.Thread(target=refresh, daemon=True).start()
+
+    def add(self, book):
+        with self.lock:
+            book_id = book["_id"]
+            if book_id in self.books:
+                self.remove(book_id)
+            title_words = set(tokenize(book["book_title"]))
+            words = title_words | set(tokenize(book["book_author"]))
+            self.books[book_id] = {
+                "_id": book_id,
+                "book_title": book["book_title"],
+                "book_author": book["book_author"],
+                "words": words,
+                "title_words": title_words
+            }
+            for word in words:
+                if word not in self.word_books:
+                    self.word_books[word] = set()
+                    insort(self.words, word)
+                    word_trigrams = trigrams(word)
+                    self.word_trigrams[word] = len(word_trigrams)
+                    for trigram in word_trigrams:
+                        self.trigram_words.setdefault(
+                            trigram, set()).add(word)
+                self.word_books[word].add(book_id)
+
+    def remove(self, book_id):
+        with self.lock:
+            book = self.books.pop(book_id, None)
+            if book is None:
+                return
+            for word in book["words"]:
+                self.word_books[word].discard(book_id)
+                if not self.word_books[word]:
+                    del self.word_books[word]
+                    del self.words[bisect_left(self.words, word)]
+                    del self.word_trigrams[word]
+                    for trigram in trigrams(word):
+                        self.trigram_words[trigram].discard(word)
+
+    # range of the sorted words starting with the prefix
+    def prefix_range(self, prefix):
+        start = bisect_left(self.words, prefix)
+        end = bisect_left(self.words, prefix + '\uffff', start)
+        return start, end
+
+    # books having a word starting with each word of the query,
+    # in alphabetical order of the matching words
+    def complete(self, query, limit=10):
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        with self.lock:
+            ranges = [self.prefix_range(token) for token in tokens]
+            # walks the smallest range and checks the other words
+            # on each candidate
+            selective = min(range(len(tokens)),
+                            key=lambda i: ranges[i][1] - ranges[i][0])
+            others = [token for i, token in enumerate(tokens)
+                      if i != selective]
+            start, end = ranges[selective]
+            results = []
+            seen = set()
+            for index in range(start, end):
+                for book_id in self.word_books[self.words[index]]:
+                    if book_id in seen:
+                        continue
+                    seen.add(book_id)
+                    book = self.books[book_id]
+                    if all(any(book_word.startswith(token)
+                               for book_word in book["words"])
+                           for token in others):
+                        results.append(book)
+                        if len(results) == limit:
+                            return self.public(results)
+            return self.public(results)
+
+    # words of the vocabulary close to a possibly misspelled word, with
+    # their similarity, the closest first. An indexed word is only close
+    # to itself
+    def close_words(self, word, min_similarity=0.4, limit=5):
+        if word in self.word_books:
+            return {word: 1.0}
+        word_trigrams = trigrams(word)
+        shared = {}
+        for trigram in word_trigrams:
+            for candidate in self.trigram_words.get(trigram, ()):
+                shared[candidate] = shared.get(candidate, 0) + 1
+        similar = []
+        for candidate, count in shared.items():
+            # Jaccard similarity of the two sets of trigrams
+            similarity = count / (len(word_trigrams)
+                                  + self.word_trigrams[candidate] - count)
+            if similarity >= min_similarity:
+                similar.append((similarity, candidate))
+        similar.sort(key=lambda item: (-item[0], item[1]))
+        return {candidate: similarity
+                for similarity, candidate in similar[:limit]}
+
+    # closest word of the vocabulary to a possibly misspelled word
+    def closest_word(self, word, min_similarity=0.4):
+        return next(iter(self.close_words(word, min_similarity)), None)
+
+    # corrects each word of the query to the closest indexed word,
+    # returns None when a word has no close match
+    def correct(self, query):
+        with self.lock:
+            corrected = []
+            for token in tokenize(query):
+                word = self.closest_word(token)
+                if word is None:
+                    return None
+                corrected.append(word)
+            return ' '.join(corrected) or None
+
+    # Books having a word close to each word of the query, with the
+    # query corrected to the closest words. The books are ranked by the
+    # similarity of their words to the query, then by the words found in
+    # their title rather than in their author, then by how few other
+    # words they have
+    def fuzzy_search(self, query, limit=10):
+        with self.lock:
+            candidates = [self.close_words(token)
+                          for token in tokenize(query)]
+            if not candidates or not all(candidates):
+                return None, []
+            corrected = ' '.join(next(iter(words)) for words in candidates)
+            scores = None
+            for words in candidates:
+                # best match of the query word in each book, as
+                # (similarity, found in the title)
+                matches = {}
+                for word, similarity in words.items():
+                    for book_id in self.word_books[word]:
+                        match = (similarity,
+                                 word in self.books[book_id]["title_words"])
+                        matches[book_id] = max(matches.get(book_id, match),
+                                               match)
+                if scores is None:
+                    scores = matches
+                else:
+                    scores = {
+                        book_id: (score[0] + matches[book_id][0],
+                                  score[1] + matches[book_id][1])
+                        for book_id, score in scores.items()
+                        if book_id in matches
+                    }
+            books = sorted(
+                (self.books[book_id] for book_id in scores),
+                key=lambda book: (-scores[book["_id"]][0],
+                                  -scores[book["_id"]][1],
+                                  len(book["words"]),
+                                  book["book_title"]))
+            return corrected, self.public(books[:limit])
+
+    @staticmethod
+    def public(books):
+        return [
+            {
+                "_id": book["_id"],
+                "book_title": book["book_title"],
+                "book_author": book["book_author"]
+            }
+            for book in books
+        ]
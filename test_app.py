@@ -1,9 +1,40 @@
 import os
+import tempfile
+import time
 import unittest
-from flask import Flask, url_for, render_template, redirect, request
-from datetime import date
-from flask_pymongo import PyMongo
-from app import app, best_ten_books, delete, verify_password
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, url_for, render_template, redirect, request, json
+from datetime import date, datetime, timedelta
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, TEXT
+from app import (
+    create_app,
+    best_ten_books,
+    delete,
+    verify_password,
+    rating_aggregates,
+    compact_rating_list,
+    best_book_today,
+    best_book_this_week,
+    init_indexes,
+    page_cache,
+    count_author_book,
+    search_index,
+    request_metrics,
+    rate_limiter,
+    reference_data,
+    assets,
+    mongo
+)
+from assets import build_assets
+from images import build_images
+from cache import LRUCache, PageCache
+from ratelimit import MemoryBuckets
+from search import SearchIndex
+
+# the tests send many requests from the same client; the rate limits
+# are switched on by the tests checking them
+app = create_app({"RATE_LIMIT_ENABLED": False})
 
 
 class TestApp(unittest.TestCase):
@@ -12,10 +43,13 @@ class TestApp(unittest.TestCase):
     # CLASS VARIABLES
     ########################
 
-    mongo = PyMongo(app)
+    # the tests use the Mongo client of the app and its pool
     books = mongo.db.books
     authors = mongo.db.authors
     genres = mongo.db.genres
+    daily_ratings = mongo.db.daily_ratings
+    comments = mongo.db.comments
+    stats_snapshot = mongo.db.stats_snapshot
     # test book
 
     title = "test title"
@@ -23,31 +57,43 @@ class TestApp(unittest.TestCase):
     author = "test author"
     genre = "test genre"
     description = "test description that ends here. And, then, goes on."
-    rating = []
-    test_book = {
-        "book_title": title,
-        "book_author": author,
-        "book_genre": genre,
-        "book_description": description,
-        "book_rating": rating,
-        "password": password
-    }
     ########################
     # HELPER METHODS
     ########################
 
+    # winning plan chosen by MongoDB for a query, as a string
+    def winning_plan(self, cursor):
+        return str(cursor.explain()["queryPlanner"]["winningPlan"])
+
     # server response to specific url request
     def server_response(self, page):
         return self.test_client.get(page)
 
-    # inserts a test book in Mongo DB
+    # inserts a test book in Mongo DB. Its rating list is compacted into
+    # the rating aggregates and daily rating buckets the app stores for
+    # its ratings
     def insert_book(self, book):
         TestApp.books.insert_one(book)
+        count_author_book(book['book_author'], 1)
+        page_cache.clear()
+        TestApp.stats_snapshot.delete_many({})
+        if isinstance(book.get('book_rating'), list):
+            compact_rating_list(book)
 
-    # remove a test book in Mongo DB
+    # remove a test book in Mongo DB, with its daily rating buckets,
+    # its comments and its count in the author books
 
     def remove_book(self, book):
-        TestApp.books.delete_one(book)
+        # the rating list of the book is not stored, so a book inserted by
+        # insert_book is found by its id
+        if '_id' in book:
+            book = {"_id": book['_id']}
+        book_found = TestApp.books.find_one_and_delete(book)
+        if book_found:
+            TestApp.daily_ratings.delete_many({"book_id": book_found["_id"]})
+            TestApp.comments.delete_many({"book_id": book_found["_id"]})
+            count_author_book(book_found['book_author'], -1)
+            TestApp.stats_snapshot.delete_many({})
 
     ############################
     # SETUP AND TEARDOWN
@@ -56,6 +102,17 @@ class TestApp(unittest.TestCase):
     # executed prior to each test
     def setUp(self):
         self.test_client = app.test_client()
+        page_cache.clear()
+        # test book, built again for every test since the tests and
+        # insert_book add fields to it
+        self.test_book = {
+            "book_title": self.title,
+            "book_author": self.author,
+            "book_genre": self.genre,
+            "book_description": self.description,
+            "book_rating": [],
+            "password": self.password
+        }
 
     # executed after each test
     def tearDown(self):
@@ -120,6 +177,68 @@ class TestApp(unittest.TestCase):
             TestApp.remove_book(self, self.local_test_book)
             TestApp.remove_book(self, self.local_book_same_author)
 
+    # tests that the books of an author are split in pages
+    def test_books_by_author_pagination(self):
+        first_book = dict(self.test_book,
+                          book_title="first paged title",
+                          book_author="paged test author")
+        second_book = dict(first_book, book_title="second paged title")
+        TestApp.insert_book(self, first_book)
+        TestApp.insert_book(self, second_book)
+        page_size = app.config['BOOKS_PER_PAGE']
+        app.config['BOOKS_PER_PAGE'] = 1
+        url = f"/get_books_author/{first_book['book_author']}"
+        try:
+            response = self.server_response(url)
+            self.assertIn(b'First Paged Title', response.data)
+            self.assertNotIn(b'Second Paged Title', response.data)
+            self.assertIn(f"after={first_book['_id']}".encode(),
+                          response.data)
+            response = self.server_response(
+                f"{url}?after={first_book['_id']}")
+            self.assertIn(b'Second Paged Title', response.data)
+            self.assertNotIn(b'First Paged Title', response.data)
+        finally:
+            app.config['BOOKS_PER_PAGE'] = page_size
+            TestApp.remove_book(self, {"_id": first_book['_id']})
+            TestApp.remove_book(self, {"_id": second_book['_id']})
+
+    # checks that adding, editing and deleting a book keeps the number
+    # of books of the authors up to date
+    def test_author_book_count(self):
+        def book_count(author_name):
+            author = TestApp.authors.find_one({"author_name": author_name})
+            return author.get("book_count", 0) if author else 0
+
+        count_before = book_count(self.author)
+        book_id = None
+        try:
+            with self.test_client as client:
+                client.post("/insert_book", data={
+                    'book_title': 'counted title',
+                    'book_author': self.author,
+                    'book_genre': self.genre,
+                    'book_description': self.description,
+                    'password': self.password
+                })
+                self.assertEqual(count_before + 1, book_count(self.author))
+                book_id = TestApp.books.find_one(
+                    {"book_title": 'counted title'})['_id']
+                client.post(f"/verify_password/{book_id}/modify", data={
+                    'password': self.password,
+                    'book_title': 'counted title',
+                    'book_author': 'counted author',
+                    'book_genre': self.genre,
+                    'book_description': self.description
+                })
+                self.assertEqual(count_before, book_count(self.author))
+                self.assertEqual(1, book_count('counted author'))
+                client.get(f"/delete/{book_id}")
+                self.assertEqual(0, book_count('counted author'))
+        finally:
+            TestApp.books.delete_one({"book_title": 'counted title'})
+            TestApp.authors.delete_one({"author_name": 'counted author'})
+
     # tests average rating calculation and number of stars displayed
     def test_star_rating(self):
         self.local_test_book = self.test_book
@@ -135,9 +254,23 @@ class TestApp(unittest.TestCase):
         finally:
             TestApp.remove_book(self, self.local_test_book)
 
+    # tests the aggregates computed from a list of ratings
+    def test_rating_aggregates(self):
+        aggregates = rating_aggregates(
+            [[4, "10-Apr-2020"], [2, "11-Apr-2020"], [4, "12-Apr-2020"]])
+        self.assertEqual(10, aggregates['rating_sum'])
+        self.assertEqual(3, aggregates['rating_count'])
+        self.assertAlmostEqual(10 / 3, aggregates['rating_mean'])
+        self.assertEqual(
+            {'1': 0, '2': 1, '3': 0, '4': 2, '5': 0},
+            aggregates['rating_histogram']
+        )
+        self.assertEqual('★★★☆☆', aggregates['star_rating'])
+        self.assertEqual('✩✩✩✩✩', rating_aggregates([])['star_rating'])
+
     # checks if the description is shortened on the main page
     def test_description_is_shortened(self):
-        TestApp.insert_book(self, TestApp.test_book)
+        TestApp.insert_book(self, self.test_book)
         response = self.server_response("/")
         try:
             self.assertIn(b"test description that ends here.", response.data)
@@ -240,9 +373,10 @@ class TestApp(unittest.TestCase):
             with self.test_client as client:
                 response = client.post(f"/insert_genre",
                                        data={
-                                           'genre_name': self.genre
+                                           'genre_name': self.genre.title()
                                        }
                                        )
+                # the genre is stored lowercased, like the book genres
                 book_search = TestApp.genres.find_one(
                     {"genre_name": self.genre})
                 self.assertEqual(self.genre, book_search['genre_name'])
@@ -263,8 +397,8 @@ class TestApp(unittest.TestCase):
                 self.assertIn(
                     b'already exists in the database!', response.data)
         finally:
-            TestApp.authors.delete_one({
-                'author_name': self.author
+            TestApp.genres.delete_one({
+                'genre_name': self.genre
             }
             )
 
@@ -316,18 +450,63 @@ class TestApp(unittest.TestCase):
         finally:
             TestApp.remove_book(self, {"book_title": "updated title"})
 
-    # checks if insert_rating() correctly modifies the rating list
+    # checks that a book cannot be renamed to the title and author of
+    # another book
+    def test_edit_book_duplicate(self):
+        init_indexes()
+        other_book = dict(self.test_book, book_title="other title")
+        TestApp.insert_book(self, self.test_book)
+        TestApp.insert_book(self, other_book)
+        try:
+            response = self.test_client.post(
+                f"/verify_password/{other_book['_id']}/modify",
+                data={
+                    'password': self.password,
+                    'book_title': self.title,
+                    'book_author': self.author,
+                    'book_genre': self.genre,
+                    'book_description': self.description
+                },
+                follow_redirects=True
+            )
+            self.assertIn(b'already exists in the database!', response.data)
+            book_search = TestApp.books.find_one({"_id": other_book['_id']})
+            self.assertEqual("other title", book_search['book_title'])
+        finally:
+            TestApp.remove_book(self, self.test_book)
+            TestApp.remove_book(self, other_book)
+
+    # checks that init-indexes replaces the text index of an older
+    # version of the app, and reports a unique index it cannot create
+    # because of duplicates without failing
+    def test_init_indexes_conflicts(self):
+        collection = mongo.db.test_indexes
+        collection.create_index([("book_title", TEXT)], name="old_search")
+        collection.insert_many([{"book_title": self.title},
+                                {"book_title": self.title}])
+        try:
+            errors, warnings = init_indexes({"test_indexes": [
+                ([("book_title", TEXT), ("book_author", TEXT)],
+                 {"name": "book_search"}),
+                ([("book_title", ASCENDING)], {"unique": True})
+            ]})
+            self.assertEqual([], errors)
+            self.assertEqual(1, len(warnings))
+            self.assertIn(self.title, warnings[0])
+            self.assertEqual({"_id_", "book_search"},
+                             set(collection.index_information()))
+        finally:
+            collection.drop()
+
+    # checks if insert_rating() correctly counts the vote in the star
+    # histogram and in the bucket of the day
 
     def test_insert_rating(self):
         self.local_test_book = self.test_book
         TestApp.insert_book(self, self.local_test_book)
         book_cursor = TestApp.books.find_one(
             {"book_title": self.local_test_book['book_title']})
-        current_rating = book_cursor["book_rating"]
         new_rating = "1"
-        rating_date = date.today().strftime("%d-%b-%Y")
-        new_rating_list = [int(new_rating), rating_date]
-        current_rating.append(new_rating_list)
         book_id = book_cursor['_id']
         try:
             with self.test_client as client:
@@ -337,23 +516,85 @@ class TestApp(unittest.TestCase):
                                        }
                                        )
                 book_search = TestApp.books.find_one({"_id": book_id})
-                self.assertEqual(current_rating, book_search['book_rating'])
+                # the rating list is not stored anymore
+                self.assertNotIn('book_rating', book_search)
+                bucket = TestApp.daily_ratings.find_one({
+                    "book_id": book_id,
+                    "day": datetime.combine(date.today(), datetime.min.time())
+                })
+                self.assertEqual(1, bucket['rating_count'])
+                # checks that the stored aggregates follow the new vote
+                self.assertEqual(1, book_search['rating_count'])
+                self.assertEqual(1, book_search['rating_sum'])
+                self.assertEqual(1, book_search['rating_mean'])
+                self.assertEqual(1, book_search['rating_histogram']['1'])
+                self.assertEqual('★☆☆☆☆', book_search['star_rating'])
+                # only scores from 1 to 5 are counted
+                for rating in ('6', '0', '-3', 'five'):
+                    response = client.post(f"/insert_rating/{book_id}",
+                                           data={'rating': rating})
+                    self.assertEqual(400, response.status_code)
+                book_search = TestApp.books.find_one({"_id": book_id})
+                self.assertEqual(1, book_search['rating_count'])
+                # a vote for a book that does not exist is not counted
+                missing_id = ObjectId()
+                response = client.post(f"/insert_rating/{missing_id}",
+                                       data={'rating': '5'})
+                self.assertEqual(404, response.status_code)
+                self.assertIsNone(
+                    TestApp.daily_ratings.find_one({"book_id": missing_id}))
         finally:
             TestApp.remove_book(self, {"_id": book_id})
 
-    # checks if insert_comment() correctly modifies the comments list
+    # checks that removing the rating list of a book keeps the votes cast
+    # since the list stopped growing
+    def test_compact_ratings(self):
+        # a book of an older version, its votes in a list and in the
+        # aggregates, the vote of the first day also counted in its
+        # daily bucket
+        book_rating = [[4, "10-Apr-2020"], [2, "11-Apr-2020"]]
+        self.test_book['book_rating'] = book_rating
+        self.test_book.update(rating_aggregates(book_rating))
+        TestApp.books.insert_one(self.test_book)
+        book_id = self.test_book['_id']
+        TestApp.daily_ratings.insert_one({
+            "book_id": book_id,
+            "day": datetime(2020, 4, 10),
+            "rating_sum": 4,
+            "rating_count": 1
+        })
+        runner = app.test_cli_runner()
+        try:
+            self.test_client.post(f"/insert_rating/{book_id}",
+                                  data={'rating': '5'})
+            result = runner.invoke(args=['backfill-ratings', '--all'])
+            self.assertIn("1 books skipped", result.output)
+            result = runner.invoke(args=['compact-ratings'])
+            self.assertIn("Ratings compacted on 1 books", result.output)
+            book_search = TestApp.books.find_one({"_id": book_id})
+            self.assertNotIn('book_rating', book_search)
+            self.assertEqual(3, book_search['rating_count'])
+            self.assertEqual(11, book_search['rating_sum'])
+            # the votes of the list are in the buckets once, with the
+            # vote cast since
+            buckets = list(TestApp.daily_ratings.find({"book_id": book_id}))
+            self.assertEqual(3, len(buckets))
+            self.assertEqual(3, sum(bucket['rating_count']
+                                    for bucket in buckets))
+            self.assertEqual(11, sum(bucket['rating_sum']
+                                     for bucket in buckets))
+        finally:
+            TestApp.books.delete_one({"_id": book_id})
+            TestApp.daily_ratings.delete_many({"book_id": book_id})
+
+    # checks if insert_comment() correctly adds a comment to the book
     def test_insert_comment(self):
         self.local_test_book = self.test_book
         TestApp.insert_book(self, self.local_test_book)
         book_cursor = TestApp.books.find_one(
             {"book_title": self.local_test_book['book_title']})
-        current_comments = []
-        if "book_comments" in book_cursor:
-            current_comments = book_cursor["book_comments"]
         new_comment = "test comment"
         new_comment_author = "test comment author"
-        new_comment_list = [new_comment, new_comment_author]
-        current_comments.append(new_comment_list)
         book_id = book_cursor['_id']
         try:
             with self.test_client as client:
@@ -364,19 +605,517 @@ class TestApp(unittest.TestCase):
                                            'book_comment': new_comment
                                        }
                                        )
+                comments = [
+                    [comment['text'], comment['author']]
+                    for comment in TestApp.comments.find({"book_id": book_id})
+                ]
+                self.assertEqual([[new_comment, new_comment_author]],
+                                 comments)
                 book_search = TestApp.books.find_one({"_id": book_id})
-                self.assertEqual(current_comments,
-                                 book_search['book_comments'])
+                self.assertEqual(1, book_search['comment_count'])
+                self.assertNotIn('book_comments', book_search)
+        finally:
+            TestApp.remove_book(self, {"_id": book_id})
+
+    # checks that the comments of a book are served a page at a time,
+    # from the oldest
+    def test_book_comments_pages(self):
+        self.local_test_book = self.test_book
+        TestApp.insert_book(self, self.local_test_book)
+        book_id = self.local_test_book['_id']
+        per_page = app.config['COMMENTS_PER_PAGE']
+        try:
+            for number in range(per_page + 2):
+                self.test_client.post(f"/insert_comment/{book_id}", data={
+                    'comment_author': "test comment author",
+                    'book_comment': f"comment {number}"
+                })
+            response = self.server_response(f"/api/books/{book_id}/comments")
+            first_page = response.get_json()
+            self.assertEqual(per_page, len(first_page['comments']))
+            self.assertEqual("comment 0", first_page['comments'][0]['text'])
+            response = self.server_response(
+                f"/api/books/{book_id}/comments"
+                f"?after={first_page['next_after']}")
+            second_page = response.get_json()
+            self.assertEqual([f"comment {per_page}",
+                              f"comment {per_page + 1}"],
+                             [comment['text']
+                              for comment in second_page['comments']])
+            self.assertIsNone(second_page['next_after'])
+            response = self.server_response(f"/book/{book_id}")
+            self.assertIn(b"More comments", response.data)
+        finally:
+            TestApp.remove_book(self, {"_id": book_id})
+
+    # checks that the comments are paged the same way when the server
+    # does not run in UTC
+    def test_book_comments_pages_local_time(self):
+        local_timezone = os.environ.get('TZ')
+        os.environ['TZ'] = "America/New_York"
+        time.tzset()
+        try:
+            self.test_book_comments_pages()
+        finally:
+            if local_timezone is None:
+                del os.environ['TZ']
+            else:
+                os.environ['TZ'] = local_timezone
+            time.tzset()
+
+    # checks that concurrent votes and comments are all recorded
+    def test_concurrent_rating_and_comments(self):
+        self.local_test_book = self.test_book
+        self.local_test_book['book_rating'] = []
+        TestApp.insert_book(self, self.local_test_book)
+        book_id = self.local_test_book['_id']
+        votes = 50
+
+        def post(url, data):
+            return app.test_client().post(url, data=data).status_code
+
+        try:
+            with ThreadPoolExecutor(max_workers=10) as executor:
+                rating_status = list(executor.map(
+                    lambda vote: post(f"/insert_rating/{book_id}",
+                                      {'rating': str(vote % 5 + 1)}),
+                    range(votes)
+                ))
+                comment_status = list(executor.map(
+                    lambda vote: post(f"/insert_comment/{book_id}",
+                                      {'comment_author': f"author {vote}",
+                                       'book_comment': "test comment"}),
+                    range(votes)
+                ))
+            self.assertEqual([302] * votes, rating_status)
+            self.assertEqual([302] * votes, comment_status)
+            book_search = TestApp.books.find_one({"_id": book_id})
+            self.assertEqual(votes, book_search['rating_count'])
+            self.assertEqual(votes * 3, book_search['rating_sum'])
+            self.assertEqual(
+                {'1': 10, '2': 10, '3': 10, '4': 10, '5': 10},
+                book_search['rating_histogram']
+            )
+            self.assertEqual(votes, book_search['comment_count'])
+            self.assertEqual(
+                votes, TestApp.comments.count_documents({"book_id": book_id}))
+        finally:
+            TestApp.remove_book(self, {"_id": book_id})
+
+    # checks that the hot queries of the app are served by an index
+    def test_queries_use_indexes(self):
+        init_indexes()
+        queries = [
+            TestApp.books.find(
+                {"book_title": self.title, "book_author": self.author}),
+            TestApp.books.find({"book_genre": self.genre}).sort("_id", 1),
+            TestApp.books.find({"book_author": self.author}).sort("_id", 1),
+            TestApp.books.find().sort("rating_mean", -1).limit(10),
+            TestApp.books.find().sort("rating_count", -1).limit(1),
+            TestApp.authors.find({"author_name": self.author}),
+            TestApp.genres.find({"genre_name": self.genre}),
+            TestApp.daily_ratings.find(
+                {"day": {"$gte": datetime(2020, 4, 10)}})
+        ]
+        for cursor in queries:
+            self.assertIn("IXSCAN", self.winning_plan(cursor))
+        text_query = TestApp.books.find({'$text': {'$search': self.title}})
+        self.assertNotIn("COLLSCAN", self.winning_plan(text_query))
+
+    # checks that cached pages can be revalidated by the browser
+    def test_cached_page_revalidation(self):
+        # the first request streams the page and caches it once sent
+        self.server_response('/get_genres').get_data()
+        response = self.server_response('/get_genres')
+        etag = response.headers['ETag']
+        self.assertIn('Last-Modified', response.headers)
+        response = self.test_client.get(
+            '/get_genres', headers={'If-None-Match': etag})
+        self.assertEqual(304, response.status_code)
+
+    # checks that writing to a book invalidates its cached page
+    def test_cached_page_invalidation(self):
+        self.local_test_book = self.test_book
+        TestApp.insert_book(self, self.local_test_book)
+        book_id = self.local_test_book['_id']
+        try:
+            response = self.server_response(f"/book/{book_id}")
+            self.assertNotIn(b'cached page comment', response.data)
+            self.test_client.post(f"/insert_comment/{book_id}",
+                                  data={
+                                      'comment_author': 'test comment author',
+                                      'book_comment': 'cached page comment'
+                                  },
+                                  follow_redirects=True)
+            response = self.server_response(f"/book/{book_id}")
+            self.assertIn(b'cached page comment', response.data)
         finally:
             TestApp.remove_book(self, {"_id": book_id})
 
+    # checks that the health check pings MongoDB
+    def test_healthz(self):
+        response = self.server_response('/healthz')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual("ok", response.get_json()["status"])
+
+    # checks that the Mongo commands of a route are counted and that
+    # slow requests are logged with their commands, once the page
+    # streamed by the route has been sent
+    def test_request_metrics(self):
+        request_metrics.clear()
+        slow_request_seconds = request_metrics.slow_request_seconds
+        request_metrics.slow_request_seconds = 0
+        try:
+            with self.assertLogs(app.logger, 'WARNING') as logs:
+                self.server_response(
+                    f'/get_books_author/{self.author}').get_data()
+        finally:
+            request_metrics.slow_request_seconds = slow_request_seconds
+        self.assertIn('Slow request GET /get_books_author/', logs.output[0])
+        self.assertIn('find books', logs.output[0])
+        response = self.server_response('/metrics')
+        self.assertIn(
+            b'booksters_requests_total{endpoint="main.get_books_by_author"} 1',
+            response.data)
+        self.assertNotIn(
+            b'booksters_mongo_commands_total'
+            b'{endpoint="main.get_books_by_author"} 0',
+            response.data)
+
+    # checks that the authors page is served from memory and follows the
+    # changes of the authors collection
+    def test_reference_data(self):
+        self.server_response('/get_authors').get_data()
+        request_metrics.clear()
+        page_cache.clear()
+        self.server_response('/get_authors').get_data()
+        response = self.server_response('/metrics')
+        # the only command is the lookup of the page cache tags
+        self.assertIn(
+            b'booksters_mongo_commands_total{endpoint="main.get_authors"} 1',
+            response.data)
+        author = {"_id": ObjectId(), "author_name": "reference author"}
+        reference_data.apply({"ns": {"coll": "authors"},
+                              "operationType": "insert",
+                              "fullDocument": author})
+        response = self.server_response('/get_authors')
+        self.assertIn(b'Reference Author', response.data)
+        reference_data.apply({"ns": {"coll": "authors"},
+                              "operationType": "delete",
+                              "documentKey": {"_id": author["_id"]}})
+        response = self.server_response('/get_authors')
+        self.assertNotIn(b'Reference Author', response.data)
+
+    # checks that a page invalidated by a worker is invalidated for the
+    # other workers, which keep their own copy of the pages
+    def test_page_cache_shared_invalidation(self):
+        other_worker = PageCache(app, lambda: mongo.db)
+        try:
+            cached_at = other_worker.tags.times(["book:shared"])["book:shared"]
+            time.sleep(0.01)
+            page_cache.invalidate("book:shared")
+            written = other_worker.tags.times(["book:shared"])["book:shared"]
+            self.assertGreater(written, cached_at)
+        finally:
+            mongo.db.page_cache_tags.delete_one({"_id": "book:shared"})
+
+    # checks that a client sending too many votes gets a 429 while the
+    # other clients can still vote, and that requests are shed while
+    # MongoDB is slow
+    def test_rate_limit(self):
+        self.local_test_book = self.test_book
+        TestApp.insert_book(self, self.local_test_book)
+        book_id = self.local_test_book['_id']
+        app.config.update(RATE_LIMIT_ENABLED=True,
+                          RATE_LIMIT_VOTES="2/minute")
+        rate_limiter.clear()
+        try:
+            statuses = [
+                self.test_client.post(f"/insert_rating/{book_id}",
+                                      data={'rating': '5'}).status_code
+                for _ in range(3)
+            ]
+            self.assertEqual([302, 302, 429], statuses)
+            response = self.test_client.post(f"/insert_rating/{book_id}",
+                                             data={'rating': '5'})
+            self.assertGreater(int(response.headers['Retry-After']), 0)
+            response = self.test_client.post(
+                f"/insert_rating/{book_id}", data={'rating': '5'},
+                environ_base={'REMOTE_ADDR': '10.0.0.2'})
+            self.assertEqual(302, response.status_code)
+            book_search = TestApp.books.find_one({"_id": book_id})
+            self.assertEqual(3, book_search['rating_count'])
+            app.config['SHED_MAX_CONCURRENT'] = 0
+            rate_limiter.latency_listener.seconds = 10
+            response = self.server_response(f"/search?q={self.title}")
+            self.assertEqual(503, response.status_code)
+            response = self.server_response('/metrics')
+            self.assertIn(b'group="votes",reason="rate_limited"} 2',
+                          response.data)
+        finally:
+            app.config.update(RATE_LIMIT_ENABLED=False,
+                              RATE_LIMIT_VOTES="10/minute",
+                              SHED_MAX_CONCURRENT=8)
+            rate_limiter.latency_listener.seconds = 0
+            rate_limiter.clear()
+            TestApp.remove_book(self, {"_id": book_id})
+
+    # checks that a request rejected by the global bucket does not spend
+    # the token of its client, and that a forwarded request is warned
+    # about when no proxy is trusted
+    def test_rate_limit_buckets(self):
+        buckets = MemoryBuckets()
+        global_bucket = ("votes:global", 1 / 60, 1)
+        self.assertEqual(0, buckets.take([("votes:ip:a", 1 / 60, 1),
+                                          global_bucket]))
+        self.assertGreater(buckets.take([("votes:ip:b", 1 / 60, 1),
+                                         global_bucket]), 0)
+        self.assertEqual(0, buckets.take([("votes:ip:b", 1 / 60, 1)]))
+        app.config.update(RATE_LIMIT_ENABLED=True, TRUSTED_PROXIES=0)
+        rate_limiter.warned_proxies = False
+        try:
+            with self.assertLogs(app.logger, 'WARNING') as logs:
+                self.test_client.get(
+                    f"/search?q={self.title}",
+                    headers={"X-Forwarded-For": "203.0.113.7"})
+            self.assertIn("TRUSTED_PROXIES", logs.output[0])
+        finally:
+            app.config['RATE_LIMIT_ENABLED'] = False
+            rate_limiter.clear()
+
+    # checks that imported books are deduplicated and can be exported
+    def test_import_export_books(self):
+        record = json.dumps({
+            "book_title": "Imported Title",
+            "book_author": self.author,
+            "book_genre": self.genre,
+            "book_description": self.description,
+            "password": self.password,
+            "rating_histogram": {"4": 1}
+        })
+        # the format of the exports of older versions
+        legacy_record = json.dumps({
+            "book_title": "Legacy Title",
+            "book_author": self.author,
+            "book_genre": self.genre,
+            "book_description": self.description,
+            "password": self.password,
+            "book_rating": [[5, "10-Apr-2020"], [3, "11-Apr-2020"]]
+        })
+        runner = app.test_cli_runner()
+        with tempfile.TemporaryDirectory() as directory:
+            import_path = os.path.join(directory, "books.jsonl")
+            export_path = os.path.join(directory, "books.csv")
+            with open(import_path, "w") as import_file:
+                import_file.write(
+                    record + "\n" + record + "\n" + legacy_record + "\n")
+            try:
+                result = runner.invoke(args=['import-books', import_path])
+                self.assertIn("2 books imported, 1 skipped", result.output)
+                book = TestApp.books.find_one({"book_title": "imported title"})
+                self.assertEqual(1, book["rating_count"])
+                book = TestApp.books.find_one({"book_title": "legacy title"})
+                self.assertEqual(8, book["rating_sum"])
+                self.assertEqual(2, TestApp.daily_ratings.count_documents(
+                    {"book_id": book["_id"]}))
+                result = runner.invoke(args=['import-books', import_path])
+                self.assertIn("0 books imported, 3 skipped", result.output)
+                runner.invoke(args=['export-books', export_path])
+                with open(export_path) as export_file:
+                    self.assertIn("imported title", export_file.read())
+            finally:
+                TestApp.remove_book(self, {"book_title": "imported title"})
+                TestApp.remove_book(self, {"book_title": "legacy title"})
+
+    # checks that built assets are linked by their fingerprinted name and
+    # served precompressed with a far future Cache-Control, and that a
+    # bundle using a vendor file not downloaded is built around it
+    def test_build_assets(self):
+        with tempfile.TemporaryDirectory() as static_folder:
+            os.makedirs(os.path.join(static_folder, "css"))
+            with open(os.path.join(static_folder, "css", "test.css"),
+                      "w") as stylesheet:
+                stylesheet.write("/* test */\nbody {\n  color: red;\n}\n")
+            sizes = build_assets(static_folder, bundles={
+                "test.css": ["css/test.css"],
+                "mixed.css": ["vendor/dc.min.css", "css/test.css"]
+            }, files=[])
+            self.assertEqual({"test.css", "mixed-2.css"}, set(sizes))
+            assets.load(os.path.join(static_folder, "dist"))
+            try:
+                with app.test_request_context():
+                    url = url_for("static", filename="test.css")
+                    self.assertRegex(url, r"^/static/dist/test\.\w{10}\.css$")
+                    self.assertRegex(
+                        app.jinja_env.globals["asset_tags"]("mixed.css"),
+                        r"cdnjs\.cloudflare\.com/.*dc\.min\.css.*\n"
+                        r".*/static/dist/mixed-2\.\w{10}\.css")
+                response = self.test_client.get(
+                    url, headers={"Accept-Encoding": "gzip"})
+                self.assertEqual("gzip", response.headers["Content-Encoding"])
+                self.assertIn("immutable", response.headers["Cache-Control"])
+                response = self.test_client.get(url)
+                self.assertEqual(b"body{color:red}", response.data)
+            finally:
+                assets.load(os.path.join(app.static_folder, "dist"))
+
+    # checks that images are resized without being enlarged and offered
+    # in every size by the picture helper
+    def test_build_images(self):
+        from PIL import Image
+        with tempfile.TemporaryDirectory() as static_folder:
+            os.makedirs(os.path.join(static_folder, "img"))
+            Image.new("RGB", (800, 400), "red").save(
+                os.path.join(static_folder, "img", "test.jpg"))
+            report = build_images(static_folder, images=["img/test.jpg"],
+                                  widths=(320, 1600))
+            self.assertIn("webp 320w", report["img/test.jpg"]["variants"])
+            self.assertIn("jpeg 800w", report["img/test.jpg"]["variants"])
+            assets.load(os.path.join(static_folder, "dist"))
+            try:
+                with app.test_request_context():
+                    picture = app.jinja_env.globals["picture"](
+                        "img/test.jpg", alt="test")
+                self.assertIn('<source type="image/webp"', picture)
+                self.assertRegex(picture, r"test-320\.\w{10}\.webp 320w")
+                self.assertNotIn("1600w", picture)
+            finally:
+                assets.load(os.path.join(app.static_folder, "dist"))
+
+    # checks that the cached card of a book follows the updates of the book
+    def test_book_card_fragment_cache(self):
+        self.local_test_book = dict(self.test_book, book_rating=[])
+        self.local_test_book['updated_at'] = datetime.utcnow()
+        TestApp.insert_book(self, self.local_test_book)
+        book_id = self.local_test_book['_id']
+        url = f"/get_books_author/{self.author}"
+        try:
+            response = self.server_response(url)
+            self.assertIn(b'Based on 0 votes', response.data)
+            self.test_client.post(f"/insert_rating/{book_id}",
+                                  data={'rating': '5'})
+            response = self.server_response(url)
+            self.assertIn(b'Based on 1 votes', response.data)
+        finally:
+            TestApp.remove_book(self, {"_id": book_id})
+
+    # checks that the in-process cache evicts old and expired entries
+    def test_lru_cache(self):
+        lru_cache = LRUCache(max_entries=2)
+        lru_cache.set("first", 1)
+        lru_cache.set("second", 2)
+        lru_cache.get("first")
+        lru_cache.set("third", 3)
+        self.assertIsNone(lru_cache.get("second"))
+        self.assertEqual(1, lru_cache.get("first"))
+        lru_cache.set("expired", 4, ttl=-1)
+        self.assertIsNone(lru_cache.get("expired"))
+
+    # checks the search by title, with typos and with the autocomplete
+    def test_search_book(self):
+        init_indexes()
+        self.local_test_book = dict(self.test_book,
+                                    book_title="zanzibarian chronicles")
+        TestApp.insert_book(self, self.local_test_book)
+        search_index.add(self.local_test_book)
+        # inserted last, but the first match of the corrected search
+        other_book = dict(self.test_book, book_title="zanzibarian almanac")
+        TestApp.insert_book(self, other_book)
+        search_index.add(other_book)
+        book_title = self.local_test_book['book_title'].title()
+        try:
+            # a single result leads to the book page
+            response = self.test_client.post(
+                "/search_book/",
+                data={'book_input': 'zanzibarian'},
+                follow_redirects=True
+            )
+            self.assertIn(self.description.encode(), response.data)
+            # a misspelled search is corrected, the matches keep their
+            # order
+            response = self.server_response("/search?q=zanzibarien")
+            self.assertIn(b'Showing results for Zanzibarian', response.data)
+            self.assertLess(response.data.index(b'Zanzibarian Almanac'),
+                            response.data.index(book_title.encode()))
+            # an empty search leads to the book list
+            response = self.server_response("/search?q=+")
+            self.assertEqual(302, response.status_code)
+            self.assertTrue(response.location.endswith('/get_books'))
+            # the autocomplete suggests the book from a prefix
+            response = self.server_response("/api/autocomplete?q=zanzib")
+            self.assertIn(str(self.local_test_book['_id']),
+                          [book['_id'] for book in response.get_json()])
+        finally:
+            search_index.remove(self.local_test_book['_id'])
+            search_index.remove(other_book['_id'])
+            TestApp.remove_book(self, {"_id": self.local_test_book['_id']})
+            TestApp.remove_book(self, {"_id": other_book['_id']})
+
+    # checks that the books found despite a typo are ranked by how close
+    # their words are to the query
+    def test_fuzzy_search_ranking(self):
+        index = SearchIndex()
+        index.load([
+            {"_id": 1, "book_title": "the almanac", "book_author": "ann lee"},
+            {"_id": 2, "book_title": "the almanacs", "book_author": "ann lee"},
+            {"_id": 3, "book_title": "stories", "book_author": "al almanacs"}
+        ])
+        corrected, books = index.fuzzy_search("almanacss")
+        self.assertEqual("almanacs", corrected)
+        self.assertEqual([2, 3, 1], [book["_id"] for book in books])
+        self.assertEqual((None, []), index.fuzzy_search("qwxz"))
+
     # STATS PAGE TEST
 
+    # tests the ratings of the books of every author sent to the charts,
+    # which are stored apart from the stats snapshot
+    def test_api_stats_by_author(self):
+        self.local_test_book = self.test_book
+        self.local_test_book['book_rating'] = [[4, "10-Apr-2020"]]
+        TestApp.insert_book(self, self.local_test_book)
+        try:
+            response = self.server_response('/api/stats/by-author')
+            self.assertEqual('application/json', response.mimetype)
+            self.assertIn(
+                {"book_title": self.title.title(), "book_rating": 4},
+                response.get_json()[self.author]
+            )
+            snapshot = TestApp.stats_snapshot.find_one({"_id": "stats"})
+            self.assertNotIn("ratings_by_author", snapshot)
+            self.assertIsNotNone(mongo.db.stats_groups.find_one(
+                {"field": "book_author", "name": self.author}))
+            response = self.test_client.get(
+                '/api/stats/by-author',
+                headers={'Accept-Encoding': 'gzip'}
+            )
+            self.assertEqual('gzip', response.content_encoding)
+        finally:
+            TestApp.remove_book(self, self.local_test_book)
+
+    # checks that the stats page is read from a snapshot no older than
+    # STATS_MAX_AGE
+    def test_stats_snapshot(self):
+        TestApp.stats_snapshot.delete_many({})
+        response = self.server_response("/stats")
+        self.assertIn(b'Figures computed on', response.data)
+        snapshot = TestApp.stats_snapshot.find_one({"_id": "stats"})
+        self.assertIsNotNone(snapshot)
+        # an expired snapshot is recomputed before being shown
+        TestApp.stats_snapshot.update_one(
+            {"_id": "stats"},
+            {"$set": {"computed_at": datetime.utcnow() - timedelta(
+                seconds=app.config['STATS_MAX_AGE'] + 1)}}
+        )
+        page_cache.clear()
+        self.server_response("/stats")
+        refreshed = TestApp.stats_snapshot.find_one({"_id": "stats"})
+        self.assertGreater(refreshed["computed_at"], snapshot["computed_at"])
+
     # tests if the book rated the highest today is displayed correctly
     def test_top_day_rated_book(self):
         self.local_test_book = self.test_book
-        self.today = rating_date = date.today().strftime("%d-%b-%Y")
-        self.local_test_book['book_rating'] = [[6, self.today]]
+        self.today = date.today().strftime("%d-%b-%Y")
+        self.local_test_book['book_rating'] = [[5, self.today]]
         TestApp.insert_book(self, self.local_test_book)
         response = self.server_response("/stats")
         self.today_p = date.today().strftime("%d %B %Y")
@@ -392,35 +1131,69 @@ class TestApp(unittest.TestCase):
             self.assertIn(top_rated_today_p.encode(), response.data)
         finally:
             TestApp.remove_book(self, self.local_test_book)
+
+    # tests that ratings of previous days only count for the week, and
+    # that the votes of a removed book do not count
+    def test_top_week_rated_book(self):
+        self.local_test_book = self.test_book
+        yesterday = (date.today() - timedelta(days=1)).strftime("%d-%b-%Y")
+        self.local_test_book['book_rating'] = [[5, yesterday]]
+        TestApp.insert_book(self, self.local_test_book)
+        removed_id = ObjectId()
+        TestApp.daily_ratings.insert_one({
+            "book_id": removed_id,
+            "day": datetime.combine(date.today(), datetime.min.time()),
+            "rating_sum": 10,
+            "rating_count": 1
+        })
+        try:
+            self.assertEqual(
+                [self.local_test_book['_id'], self.title, 5],
+                best_book_this_week()
+            )
+            self.assertNotEqual(
+                self.local_test_book['_id'], best_book_today()[0])
+            self.assertNotEqual(removed_id, best_book_today()[0])
+        finally:
+            TestApp.daily_ratings.delete_many({"book_id": removed_id})
+            TestApp.remove_book(self, self.local_test_book)
+
     # tests if the top rated booked is correctly identified
 
     def test_top_rated_book(self):
         self.local_test_book = self.test_book
-        self.local_test_book['book_rating'] = [[6, "10-Apr-2020"]]
+        self.local_test_book['book_rating'] = [[5, "10-Apr-2020"]]
         TestApp.insert_book(self, self.local_test_book)
-        top_book = best_ten_books()[0]["book_title"]
-        top_rating = best_ten_books()[0]["book_rating"]
         try:
-            self.assertEqual(top_book, self.local_test_book['book_title'])
-            self.assertEqual(
-                top_rating, self.local_test_book['book_rating'][0][0])
+            top_ten = best_ten_books()
+            # other books can have the top score too
+            top_books = [book["book_title"] for book in top_ten
+                         if book["book_rating"] == 5]
+            self.assertEqual(5, top_ten[0]["book_rating"])
+            self.assertIn(self.local_test_book['book_title'], top_books)
 
         finally:
             TestApp.remove_book(self, self.local_test_book)
 
+    # tests that the top rated books are at most 10, sorted by rating
+    def test_best_ten_books_sorted(self):
+        top_ten = best_ten_books()
+        ratings = [book["book_rating"] for book in top_ten]
+        self.assertLessEqual(len(top_ten), 10)
+        self.assertEqual(sorted(ratings, reverse=True), ratings)
+
     # tests if the most voted book is actually displayed in STATS page
     def test_most_voted_book(self):
         all_books = TestApp.books.find()
         most_voted_book = (
             max(
                 all_books,
-                key=lambda x: len(x["book_rating"])
+                key=lambda x: x.get("rating_count", 0)
             )
         )
-        most_voted_book_rating_list = most_voted_book['book_rating']
-        # adds to the rating list a fake extra vote
-        most_voted_book_rating_list.append([1, "22-Apr-2020"])
-        most_voted_book_rating_list_plus = most_voted_book_rating_list
+        # a rating list with a fake extra vote
+        most_voted_book_rating_list_plus = [[1, "22-Apr-2020"]] * (
+            most_voted_book.get('rating_count', 0) + 1)
         self.local_test_book = self.test_book
         # creates a book with 1+ vote than the most voted book in DB
         self.local_test_book['book_rating'] = most_voted_book_rating_list_plus
@@ -0,0 +1,4 @@
+# entry point of the production server: gunicorn -c gunicorn.conf.py wsgi:app
+from app import create_app
+
+app = create_app()